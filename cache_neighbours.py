@@ -0,0 +1,4 @@
+from td_ilg.Demo.neighbour_cacher import demo as demo_cache_neighbours
+
+if __name__ == "__main__":
+    demo_cache_neighbours()
@@ -35,6 +35,8 @@ from shapenet import ShapeNet, category_ids
 from timm.models import create_model
 import utils
 
+from td_ilg.Method.occupancy import extractOccupancy
+
 from pathlib import Path
 
 def main():
@@ -96,7 +98,10 @@ def main():
                 _, latents, centers_quantized, _, _, _ = model.encode(surface2048)
                 centers = centers_quantized.float() / 255.0 * 2 - 1
 
-                output = torch.cat([model.decoder(latents, centers, points[:, i*N:(i+1)*N])[0] for i in range(math.ceil(grid.shape[1]/N))], dim=1)
+                # the decoder transformer runs once per shape, every chunk only queries it
+                handle = model.decoder.prepare(latents, centers)
+
+                output = torch.cat([model.decoder.query(handle, points[:, i*N:(i+1)*N])[0] for i in range(math.ceil(grid.shape[1]/N))], dim=1)
 
                 pred = torch.zeros_like(output[0])
                 pred[output[0]>=0] = 1
@@ -106,9 +111,10 @@ def main():
 
                 metric_logger.update(iou=iou.item())
 
-                output = torch.cat([model.decoder(latents, centers, grid[:, i*N:(i+1)*N])[0] for i in range(math.ceil(grid.shape[1]/N))], dim=1)
+                # coarse-to-fine, only cells near the surface are queried at full density
+                volume, _ = extractOccupancy(lambda samples: model.decoder.query(handle, samples)[0], density=density, coarse_density=32, chunk_size=N, device=device)
 
-                volume = output.view(density+1, density+1, density+1).permute(1, 0, 2).cpu().numpy()
+                volume = volume.cpu().numpy()
                 verts, faces = mcubes.marching_cubes(volume, 0)
                 verts *= gap
                 verts -= 1.
@@ -4,6 +4,15 @@ class GPTConfig:
     embd_pdrop = 0.1
     resid_pdrop = 0.1
     attn_pdrop = 0.1
+    # "vanilla": CausalSelfAttention, "sdpa": SDPACausalSelfAttention
+    attn_backend = "vanilla"
+    # each position only attends to itself and the attn_window - 1 positions before
+    # it, 0 attends to the whole prefix. "vanilla" masks the full block_size^2
+    # scores, "sdpa" only computes the window, at a cost linear in the sequence
+    attn_window = 0
+    # with an attn_window, the attn_global first positions (e.g. the class token)
+    # are still attended to by every position
+    attn_global = 0
 
     def __init__(self, vocab_size, block_size, **kwargs):
         self.vocab_size = vocab_size
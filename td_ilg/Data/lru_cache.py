@@ -0,0 +1,40 @@
+from collections import OrderedDict
+
+
+class LRUCache(object):
+    """Keep the max_size most recently used values, evicting the oldest first."""
+
+    def __init__(self, max_size=64):
+        self.max_size = max_size
+        self.cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        return
+
+    def __len__(self):
+        return len(self.cache)
+
+    def __contains__(self, key):
+        return key in self.cache
+
+    def get(self, key, default=None):
+        if key not in self.cache:
+            self.misses += 1
+            return default
+
+        self.hits += 1
+        self.cache.move_to_end(key)
+        return self.cache[key]
+
+    def put(self, key, value):
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+        return True
+
+    def clear(self):
+        self.cache.clear()
+        self.hits = 0
+        self.misses = 0
+        return True
@@ -5,10 +5,13 @@ from tqdm import tqdm
 from torch.utils.data import Dataset
 
 from td_ilg.Config.shapenet import CATEGORY_IDS
+from td_ilg.Method.curve import toCurveKey
 
 
 class ASDFDataset(Dataset):
-    def __init__(self, asdf_dataset_folder_path: str) -> None:
+    def __init__(self, asdf_dataset_folder_path: str, order: str = "random") -> None:
+        # anchor order: "random" or a space-filling curve, "xyz", "morton", "hilbert"
+        self.order = order
         self.asdf_file_list = []
         # self.context_files_list = []
 
@@ -85,6 +88,12 @@ class ASDFDataset(Dataset):
         asdf_file_path = self.asdf_file_list[idx]
         asdf = np.load(asdf_file_path, allow_pickle=True).item()["params"]
         shuffle_asdf = np.random.permutation(asdf)
+        if self.order != "random":
+            # anchors are binned to 0 ... 256 below, hence 9 bits
+            key = toCurveKey(
+                ((shuffle_asdf[:, :3] + 1.0) * 128.0).astype(np.int64), self.order, 9
+            )
+            shuffle_asdf = shuffle_asdf[np.argsort(key, kind="stable")]
 
         """
         context_file_path = choice(self.context_files_list[idx])
@@ -0,0 +1,51 @@
+import os
+import torch
+import numpy as np
+from tqdm import tqdm
+from torch.utils.data import Dataset
+
+from td_ilg.Method.neighbour import loadNeighbours
+
+
+class CachedPointsDataset(Dataset):
+    """
+    un-augmented point clouds with the fps indices and kNN graphs written by
+    NeighbourCacher, fed to the encoders as idx and knn_idx
+    """
+
+    def __init__(
+        self,
+        points_folder_path: str,
+        neighbour_folder_path: str,
+    ) -> None:
+        self.points_file_list = []
+        self.neighbour_file_list = []
+
+        self.loadDataset(points_folder_path, neighbour_folder_path)
+        return
+
+    def loadDataset(self, points_folder_path: str, neighbour_folder_path: str) -> bool:
+        points_filename_list = os.listdir(points_folder_path)
+
+        for points_filename in tqdm(points_filename_list):
+            if points_filename[-4:] != ".npy":
+                continue
+
+            neighbour_file_path = neighbour_folder_path + points_filename[:-4] + ".npz"
+            if not os.path.exists(neighbour_file_path):
+                continue
+
+            self.points_file_list.append(points_folder_path + points_filename)
+            self.neighbour_file_list.append(neighbour_file_path)
+
+        return True
+
+    def __len__(self):
+        return len(self.points_file_list)
+
+    def __getitem__(self, idx):
+        # the points keep their order, the cached indices refer to it
+        points = np.load(self.points_file_list[idx], allow_pickle=True)
+        fps_idx, knn_idx = loadNeighbours(self.neighbour_file_list[idx])
+
+        return torch.from_numpy(points).type(torch.float32), fps_idx, knn_idx
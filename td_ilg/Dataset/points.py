@@ -2,7 +2,6 @@ import os
 import torch
 import numpy as np
 from tqdm import tqdm
-from random import sample
 from torch.utils.data import Dataset
 
 
@@ -48,8 +47,20 @@ class PointsDataset(Dataset):
         points = np.load(points_file_path, allow_pickle=True)
         shuffle_points = np.random.permutation(points)
 
-        sample_point_num = np.random.randint(int(self.min_points_percent * points.shape[0]), int(self.max_points_percent * points.shape[0]))
-        random_idxs = np.array(sample(list(range(points.shape[0])), sample_point_num), dtype=int)
-        sample_points = points[random_idxs]
+        sample_point_num = self.toSamplePointNum(points.shape[0])
+        # the first points of a random permutation are a random subset
+        sample_points = shuffle_points[:sample_point_num]
 
         return torch.from_numpy(sample_points).type(torch.float32), torch.from_numpy(shuffle_points).type(torch.float32)
+
+    def toSamplePointNum(self, point_num: int) -> int:
+        return np.random.randint(int(self.min_points_percent * point_num), int(self.max_points_percent * point_num))
+
+    def collate(self, batch):
+        """
+        collate_fn for batches of more than one shape: the sample point number is
+        drawn once per batch, so the sample points of all shapes stack
+        """
+        shuffle_points = torch.stack([item[1] for item in batch])
+        sample_point_num = self.toSamplePointNum(shuffle_points.shape[1])
+        return shuffle_points[:, :sample_point_num], shuffle_points
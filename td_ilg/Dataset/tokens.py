@@ -0,0 +1,69 @@
+import os
+import torch
+import numpy as np
+from torch.utils.data import Dataset
+
+
+class TokenDataset(Dataset):
+    """
+    sorted quantized centers and code indices written by Tokenizer, every shard
+    of the split is loaded into memory as compact uint8 / int16 arrays
+    center_order: checked against the order of the shards if not None
+    """
+
+    def __init__(
+        self, token_folder_path: str, split: str = "train", center_order=None
+    ) -> None:
+        self.centers = None
+        self.codes = None
+        self.categories = None
+        self.center_order = None
+
+        self.loadShards(token_folder_path, split)
+
+        if center_order is not None:
+            assert self.center_order == center_order, (
+                "tokens are sorted with center_order "
+                + str(self.center_order)
+                + ", not "
+                + str(center_order)
+            )
+        return
+
+    def loadShards(self, token_folder_path: str, split: str) -> bool:
+        shard_filename_list = sorted(
+            shard_filename
+            for shard_filename in os.listdir(token_folder_path)
+            if shard_filename.startswith(split + "_") and shard_filename[-4:] == ".npz"
+        )
+
+        centers_list, codes_list, categories_list = [], [], []
+        center_order_set = set()
+        for shard_filename in shard_filename_list:
+            with np.load(token_folder_path + shard_filename) as data:
+                centers_list.append(data["centers"])
+                codes_list.append(data["codes"])
+                categories_list.append(data["categories"])
+                # shards written before the order was saved are all sorted by xyz
+                if "center_order" in data:
+                    center_order_set.add(str(data["center_order"]))
+                else:
+                    center_order_set.add("xyz")
+
+        assert len(center_order_set) == 1, "shards sorted with different orders"
+        self.center_order = center_order_set.pop()
+
+        self.centers = np.concatenate(centers_list)
+        self.codes = np.concatenate(codes_list)
+        self.categories = np.concatenate(categories_list)
+        return True
+
+    def __len__(self):
+        return self.codes.shape[0]
+
+    def __getitem__(self, idx):
+        return (
+            torch.from_numpy(self.centers[idx].astype(np.int64)),
+            torch.from_numpy(self.codes[idx].astype(np.int64)),
+            int(self.categories[idx]),
+        )
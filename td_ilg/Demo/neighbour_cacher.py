@@ -0,0 +1,13 @@
+from td_ilg.Module.neighbour_cacher import NeighbourCacher
+
+
+def demo():
+    points_folder_path = "/home/chli/chLi/Dataset/ShapeNet/points/10000/03001627/"
+    save_folder_path = "/home/chli/chLi/Dataset/ShapeNet/neighbours/10000/03001627/"
+
+    neighbour_cacher = NeighbourCacher()
+    # graphs of the ASDFEncoder of ASDFAutoEncoderTrainer
+    neighbour_cacher.encoder_type = "asdf"
+    neighbour_cacher.sample_num = 100
+    neighbour_cacher.cacheFolder(points_folder_path, save_folder_path)
+    return True
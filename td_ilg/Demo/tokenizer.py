@@ -0,0 +1,7 @@
+from td_ilg.Module.tokenizer import Tokenizer
+
+
+def demo():
+    tokenizer = Tokenizer()
+    tokenizer.tokenize()
+    return True
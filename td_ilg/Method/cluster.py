@@ -0,0 +1,106 @@
+import torch
+
+
+def toPaddedBatch(src, batch=None, batch_size=None):
+    """
+    src: N x D points sorted by batch, batch: N batch ids
+    returns the B x N_max x D padded points, the B x N_max valid mask and the
+    offset and count of each batch in src
+    """
+    if batch is None:
+        batch = torch.zeros(src.shape[0], dtype=torch.long, device=src.device)
+    if batch_size is None:
+        batch_size = int(batch.max()) + 1
+
+    counts = torch.bincount(batch, minlength=batch_size)
+    offsets = torch.cumsum(counts, dim=0) - counts
+    local_idx = torch.arange(src.shape[0], device=src.device) - offsets[batch]
+
+    max_count = int(counts.max())
+    points = src.new_zeros(batch_size, max_count, src.shape[1])
+    points[batch, local_idx] = src
+    valid = torch.zeros(batch_size, max_count, dtype=torch.bool, device=src.device)
+    valid[batch, local_idx] = True
+    return points, valid, offsets, counts
+
+
+@torch.no_grad()
+def fps(src, batch=None, ratio=0.5, random_start=True):
+    """
+    batched farthest point sampling with the torch_cluster.fps interface
+    src: N x D points sorted by batch, batch: N batch ids
+    returns the indices into src of ceil(ratio * count) points of each batch
+    """
+    points, valid, offsets, counts = toPaddedBatch(src, batch)
+    B = points.shape[0]
+    batch_idx = torch.arange(B, device=src.device)
+
+    sample_nums = torch.ceil(counts.float() * ratio).long()
+    S = int(sample_nums.max())
+
+    if random_start:
+        current = (torch.rand(B, device=src.device) * counts).long()
+    else:
+        current = torch.zeros(B, dtype=torch.long, device=src.device)
+
+    # padded points are never the farthest
+    min_dist = torch.full(valid.shape, float("inf"), device=src.device)
+    min_dist[~valid] = -1.0
+
+    sample_idx = torch.zeros(B, S, dtype=torch.long, device=src.device)
+    for i in range(S):
+        sample_idx[:, i] = current
+        dist = (points - points[batch_idx, current][:, None]).square().sum(dim=2)
+        min_dist = torch.where(valid, torch.minimum(min_dist, dist), min_dist)
+        current = torch.argmax(min_dist, dim=1)
+
+    keep = torch.arange(S, device=src.device)[None] < sample_nums[:, None]
+    return (sample_idx + offsets[:, None])[keep]
+
+
+@torch.no_grad()
+def knn(x, y, k, batch_x=None, batch_y=None, chunk_size=1024):
+    """
+    blocked k nearest neighbours with the torch_cluster.knn interface
+    x: N x D, y: M x D points sorted by batch, batch_x, batch_y: their batch ids
+    returns the 2 x E edges (index into y, index into x) to the k nearest points
+    of x in the same batch of every point of y, ordered by the y index
+    distances of chunk_size points of y per batch are computed at once
+    """
+    batch_size = 1
+    if batch_x is not None:
+        batch_size = max(batch_size, int(batch_x.max()) + 1)
+    if batch_y is not None:
+        batch_size = max(batch_size, int(batch_y.max()) + 1)
+
+    x_points, x_valid, x_offsets, _ = toPaddedBatch(x, batch_x, batch_size)
+    y_points, y_valid, y_offsets, _ = toPaddedBatch(y, batch_y, batch_size)
+    k = min(k, x_points.shape[1])
+
+    x_square = x_points.square().sum(dim=2)[:, None]  # B x 1 x N_max
+
+    rows = []
+    cols = []
+    for start in range(0, y_points.shape[1], chunk_size):
+        y_chunk = y_points[:, start : start + chunk_size]
+        # |y - x|^2 = |y|^2 + |x|^2 - 2 y.x
+        dist = torch.baddbmm(
+            y_chunk.square().sum(dim=2, keepdim=True) + x_square,
+            y_chunk,
+            x_points.transpose(1, 2),
+            alpha=-2,
+        )  # B x c x N_max
+        dist.masked_fill_(~x_valid[:, None], float("inf"))
+        knn_dist, knn_idx = torch.topk(dist, k, dim=2, largest=False)
+
+        edge_valid = y_valid[:, start : start + chunk_size, None] & torch.isfinite(
+            knn_dist
+        )
+        batch_idx, y_idx, neighbour_idx = edge_valid.nonzero(as_tuple=True)
+        rows.append(y_offsets[batch_idx] + start + y_idx)
+        cols.append(x_offsets[batch_idx] + knn_idx[batch_idx, y_idx, neighbour_idx])
+
+    row = torch.cat(rows)
+    col = torch.cat(cols)
+    order = torch.argsort(row, stable=True)
+    return torch.stack([row[order], col[order]], dim=0)
@@ -0,0 +1,73 @@
+# sort keys of quantized 3d positions along space-filling curves
+# positions: ... x 3 non-negative integers, numpy int64 arrays or torch long tensors,
+# only bit operations are used so both are supported
+
+
+def toPackedKey(positions, bits=8):
+    # x major, then y, then z, for bins < 2^bits
+    return (
+        (positions[..., 0] << (2 * bits))
+        | (positions[..., 1] << bits)
+        | positions[..., 2]
+    )
+
+
+def spreadBits(value):
+    # inserts two zero bits after each of the 10 lowest bits of value
+    value = value & 0x3FF
+    value = (value | (value << 16)) & 0x030000FF
+    value = (value | (value << 8)) & 0x0300F00F
+    value = (value | (value << 4)) & 0x030C30C3
+    value = (value | (value << 2)) & 0x09249249
+    return value
+
+
+def toMortonKey(positions):
+    # Z-order of bins < 1024, x is the most significant axis
+    return (
+        (spreadBits(positions[..., 0]) << 2)
+        | (spreadBits(positions[..., 1]) << 1)
+        | spreadBits(positions[..., 2])
+    )
+
+
+def toHilbertKey(positions, bits=8):
+    """
+    Hilbert curve index of bins < 2^bits, following Skilling, "Programming the
+    Hilbert curve" (2004), with the branches replaced by bit masks
+    consecutive keys are always neighbouring cells, unlike the Z-order
+    """
+    X = [positions[..., i] & ((1 << bits) - 1) for i in range(3)]
+
+    # inverse undo
+    for q in range(bits - 1, 0, -1):
+        P = (1 << q) - 1
+        for i in range(3):
+            # all ones where bit q of X[i] is set
+            is_set = -((X[i] >> q) & 1)
+            # invert the low bits of X[0] if set, else exchange them with X[i]
+            X[0] = X[0] ^ (P & is_set)
+            t = (X[0] ^ X[i]) & P & ~is_set
+            X[0] = X[0] ^ t
+            X[i] = X[i] ^ t
+
+    # gray encode
+    X[1] = X[1] ^ X[0]
+    X[2] = X[2] ^ X[1]
+    t = X[2] & 0
+    for q in range(bits - 1, 0, -1):
+        t = t ^ (((1 << q) - 1) & -((X[2] >> q) & 1))
+    X = [x ^ t for x in X]
+
+    # interleave the transposed index, X[0] holds the most significant bits
+    return (spreadBits(X[0]) << 2) | (spreadBits(X[1]) << 1) | spreadBits(X[2])
+
+
+def toCurveKey(positions, order="xyz", bits=8):
+    if order == "xyz":
+        return toPackedKey(positions, bits)
+    if order == "morton":
+        return toMortonKey(positions)
+    if order == "hilbert":
+        return toHilbertKey(positions, bits)
+    raise ValueError("unknown order: " + str(order))
@@ -1,5 +1,4 @@
 import torch
-import torch.nn.functional as F
 
 from timm.models.layers import trunc_normal_ as __call_trunc_normal_
 
@@ -8,30 +7,80 @@ def trunc_normal_(tensor, mean=0.0, std=1.0):
     __call_trunc_normal_(tensor, mean=mean, std=std, a=-std, b=std)
 
 
-def sample(logits, top_k=100, top_p=0.85):
-    temperature = 1.0
-    logits = logits[:, -1, :] / temperature
-    # FIXME: current select the best position directly for now
-    return torch.sort(logits, descending=True)[1][0, 0].reshape(1, 1)
+def createGenerators(seeds, device="cpu"):
+    if seeds is None:
+        return None
+    return [torch.Generator(device=device).manual_seed(int(seed)) for seed in seeds]
 
-    probs = F.softmax(logits, dim=-1)
 
-    topk, indices = torch.topk(probs, k=top_k, dim=-1)
-    probs = torch.zeros(*probs.shape).to(probs.device).scatter_(1, indices, topk)
+def toRowTensor(value, batch_size, dtype, device):
+    return torch.as_tensor(value, dtype=dtype, device=device).expand(batch_size)
 
-    # top-p
-    sorted_probs, sorted_indices = torch.sort(probs, descending=True)
-    cumulative_probs = torch.cumsum(sorted_probs, dim=-1)
 
-    sorted_indices_to_remove = cumulative_probs > top_p
+def sample(logits, temperature=0.0, top_k=0, top_p=1.0, generators=None):
+    """
+    logits: B x T x V, returns one index per row of the last position, B x 1
+    temperature, top_k, top_p: scalars or tensors of B per-row values,
+        temperature <= 0 decodes greedily, top_k <= 0 and top_p >= 1 disable the filters
+    generators: optional list of B torch.Generator, one random stream per row
+    """
+    logits = logits[:, -1, :]
+    B, V = logits.shape
+    device = logits.device
 
-    sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
-    sorted_indices_to_remove[..., 0] = False
+    if not torch.is_tensor(temperature) and temperature <= 0:
+        return torch.argmax(logits, dim=-1, keepdim=True)
 
-    indices_to_remove = sorted_indices_to_remove.scatter(
-        1, sorted_indices, sorted_indices_to_remove
-    )
-    probs[indices_to_remove] = 0
+    # only the top k_max candidates of each row are ever considered, no full sort
+    if torch.is_tensor(top_k):
+        top_k = torch.where(top_k > 0, top_k, V).to(device).expand(B)
+        k_max = min(int(top_k.max()), V)
+    else:
+        k_max = top_k if 0 < top_k < V else V
+    values, indices = torch.topk(logits, k_max, dim=-1)  # B x k, descending
 
-    ix = torch.multinomial(probs, num_samples=1)
-    return ix
+    temperature = toRowTensor(temperature, B, logits.dtype, device)
+    greedy = temperature <= 0
+    temperature = temperature.clamp(min=1e-6)[:, None]
+    values = values / temperature
+
+    if torch.is_tensor(top_k):
+        rank = torch.arange(k_max, device=device)[None]
+        values = values.masked_fill(rank >= top_k[:, None], float("-inf"))
+
+    if torch.is_tensor(top_p) or top_p < 1.0:
+        # probabilities w.r.t. the full vocabulary, the best candidate is always kept
+        top_p = toRowTensor(top_p, B, logits.dtype, device)
+        log_norm = torch.logsumexp(logits / temperature, dim=-1, keepdim=True)
+        probs = torch.exp(values - log_norm)
+        cumulative_probs = torch.cumsum(probs, dim=-1) - probs
+        values = values.masked_fill(cumulative_probs > top_p[:, None], float("-inf"))
+
+    # Gumbel-max: argmax(values + g) is a sample of softmax(values)
+    if generators is None:
+        u = torch.rand_like(values)
+    else:
+        u = torch.stack(
+            [
+                torch.rand(
+                    k_max, generator=generator, dtype=values.dtype, device=device
+                )
+                for generator in generators
+            ]
+        )
+    gumbel = -torch.log(-torch.log(u.clamp(min=1e-20, max=1.0 - 1e-7)))
+    choice = torch.argmax(values + gumbel, dim=-1, keepdim=True)
+
+    ix = torch.gather(indices, 1, choice)
+    return torch.where(greedy[:, None], indices[:, :1], ix)
+
+
+def getModelVersion(model, weight):
+    """
+    key of the current parameters of model, e.g. to invalidate cached activations
+    the summed tensor versions change whenever a parameter is updated in place,
+    the data pointer and dtype of weight, one parameter of model, when it is
+    loaded, moved or cast
+    """
+    version = sum(param._version for param in model.parameters())
+    return (version, weight.data_ptr(), weight.dtype)
@@ -0,0 +1,75 @@
+import os
+import torch
+import numpy as np
+from math import ceil
+
+try:
+    from torch_cluster import fps, knn
+except ImportError:
+    from td_ilg.Method.cluster import fps, knn
+
+
+def toNeighbourNum(point_num, sample_num, encoder_type="asdf"):
+    """
+    k of the kNN graph an encoder builds around each of its sample_num fps samples
+    of a point_num points cloud: "asdf", ASDFEncoder with sample_num = asdf_channel,
+    covers the cloud with ceil(point_num / sample_num) neighbours per sample,
+    "vqvae", the VQVAE Encoder with sample_num = N, always uses 32
+    """
+    if encoder_type == "asdf":
+        return ceil(point_num / sample_num)
+    if encoder_type == "vqvae":
+        return 32
+    raise ValueError("unknown encoder type: " + str(encoder_type))
+
+
+@torch.no_grad()
+def computeNeighbours(points, sample_num, k):
+    """
+    deterministic farthest point sampling and kNN graph of a single point cloud
+    points: N x 3
+    returns the sample_num fps indices and the sample_num x k indices of the
+    nearest points of every sample, both into points
+    """
+    N = points.shape[0]
+    fps_idx = fps(points, ratio=sample_num / N, random_start=False)[:sample_num]
+
+    row, col = knn(points, points[fps_idx], k)
+    assert row.shape[0] == sample_num * k, "the point cloud has less than k points"
+    knn_idx = col.view(sample_num, k)
+    return fps_idx, knn_idx
+
+
+def toEdgeIndex(fps_idx, knn_idx, point_num):
+    """
+    fps_idx: B x M, knn_idx: B x M x k, indices into each of the B point clouds
+    returns the B * M indices into the flattened B * point_num points and the
+    2 x (B * M * k) edges (source point, sample) expected by PointConv
+    """
+    B, M, k = knn_idx.shape
+    offsets = torch.arange(B, device=fps_idx.device)[:, None] * point_num
+
+    idx = (fps_idx + offsets).view(-1)
+    source = (knn_idx.to(fps_idx.device) + offsets[:, :, None]).view(-1)
+    target = torch.arange(B * M, device=fps_idx.device).repeat_interleave(k)
+    return idx, torch.stack([source, target], dim=0)
+
+
+def saveNeighbours(save_file_path, fps_idx, knn_idx):
+    save_folder_path = os.path.dirname(save_file_path)
+    if save_folder_path != "":
+        os.makedirs(save_folder_path, exist_ok=True)
+
+    np.savez(
+        save_file_path,
+        fps_idx=fps_idx.cpu().numpy().astype(np.int32),
+        knn_idx=knn_idx.cpu().numpy().astype(np.int32),
+    )
+    return True
+
+
+def loadNeighbours(neighbour_file_path):
+    with np.load(neighbour_file_path) as data:
+        fps_idx = torch.from_numpy(data["fps_idx"].astype(np.int64))
+        knn_idx = torch.from_numpy(data["knn_idx"].astype(np.int64))
+    return fps_idx, knn_idx
@@ -0,0 +1,109 @@
+import torch
+import torch.nn.functional as F
+
+
+def toGridPoints(density, device="cpu"):
+    # (density + 1)^3 x 3 points of the [-1, 1]^3 grid, x major
+    axis = torch.linspace(-1, 1, density + 1, device=device)
+    return torch.stack(torch.meshgrid(axis, axis, axis, indexing="ij"), dim=-1).view(
+        -1, 3
+    )
+
+
+def queryPoints(query_func, points, chunk_size):
+    # points: M x 3, query_func: 1 x n x 3 -> 1 x n values
+    values = [
+        query_func(points_chunk[None])[0]
+        for points_chunk in points.split(chunk_size, dim=0)
+    ]
+    if len(values) == 0:
+        return points.new_zeros(0)
+    return torch.cat(values, dim=0)
+
+
+def toRefineCellMask(volume, band=0.0, dilation=1):
+    """
+    volume: (r + 1)^3 grid values, returns the r^3 mask of cells whose corners
+    change sign or come within band of the surface, dilated by dilation cells
+    """
+    volume = volume[None, None]
+    max_value = F.max_pool3d(volume, kernel_size=2, stride=1)
+    min_value = -F.max_pool3d(-volume, kernel_size=2, stride=1)
+    mask = (max_value >= 0) & (min_value < 0)
+    if band > 0:
+        mask |= torch.minimum(max_value.abs(), min_value.abs()) < band
+
+    if dilation > 0:
+        mask = F.max_pool3d(
+            mask.float(), kernel_size=2 * dilation + 1, stride=1, padding=dilation
+        ).bool()
+    return mask[0, 0]
+
+
+@torch.no_grad()
+def extractOccupancy(
+    query_func,
+    density=128,
+    coarse_density=32,
+    band=0.0,
+    dilation=1,
+    chunk_size=50000,
+    device="cpu",
+):
+    """
+    coarse-to-fine evaluation of an occupancy field on the (density + 1)^3 grid
+    of [-1, 1]^3 for marching cubes.
+    the coarse_density grid is queried densely, then the resolution is doubled
+    until density is reached: values are trilinearly upsampled and only the points
+    of cells with a sign change or within band of 0 (dilated by dilation cells)
+    are queried again, grid points already queried are never queried twice
+    query_func: 1 x n x 3 samples -> 1 x n values, e.g. a decoder query
+    returns the (density + 1)^3 volume indexed by x, y, z and the number of queries
+    """
+    level_num = 0
+    while coarse_density * 2**level_num < density:
+        level_num += 1
+    assert (
+        coarse_density * 2**level_num == density
+    ), "density must be coarse_density times a power of 2"
+
+    volume = queryPoints(
+        query_func, toGridPoints(coarse_density, device), chunk_size
+    ).view(coarse_density + 1, coarse_density + 1, coarse_density + 1)
+    queried = torch.ones_like(volume, dtype=torch.bool)
+    query_num = volume.numel()
+
+    resolution = coarse_density
+    for _ in range(level_num):
+        cell_mask = toRefineCellMask(volume, band, dilation)
+
+        resolution *= 2
+        volume = F.interpolate(
+            volume[None, None],
+            size=(resolution + 1,) * 3,
+            mode="trilinear",
+            align_corners=True,
+        )[0, 0]
+        # grid points 2i of the finer grid are the grid points i of this one
+        fine_queried = torch.zeros_like(volume, dtype=torch.bool)
+        fine_queried[::2, ::2, ::2] = queried
+        queried = fine_queried
+
+        # every corner of the 8 children of a refined cell
+        fine_cell_mask = cell_mask.repeat_interleave(2, 0)
+        fine_cell_mask = fine_cell_mask.repeat_interleave(2, 1)
+        fine_cell_mask = fine_cell_mask.repeat_interleave(2, 2)
+        point_mask = F.max_pool3d(
+            fine_cell_mask[None, None].float(), kernel_size=2, stride=1, padding=1
+        )[0, 0].bool()
+        point_mask &= ~queried
+
+        point_idx = point_mask.nonzero()  # M x 3
+        points = point_idx.float() * (2.0 / resolution) - 1.0
+        volume[point_mask] = queryPoints(query_func, points, chunk_size).to(
+            volume.dtype
+        )
+        queried |= point_mask
+        query_num += point_idx.shape[0]
+
+    return volume, query_num
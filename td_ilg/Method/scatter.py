@@ -0,0 +1,28 @@
+import torch
+
+
+def scatter_max(src, index, dim=0, dim_size=None):
+    """
+    torch_scatter.scatter_max over dim 0 built on scatter_reduce
+    src: E x C, index: E destination ids
+    returns the dim_size x C maxima, 0 for destinations without entries, and the
+    position in src of each maximum, E for destinations without entries
+    """
+    assert dim == 0, "only dim 0 is supported"
+    if dim_size is None:
+        dim_size = int(index.max()) + 1
+
+    index = index[:, None].expand_as(src)
+    out = src.new_zeros(dim_size, src.shape[1]).scatter_reduce(
+        0, index, src, "amax", include_self=False
+    )
+
+    with torch.no_grad():
+        positions = torch.arange(src.shape[0], device=src.device)[:, None]
+        positions = positions.expand_as(src).masked_fill(
+            src != out.gather(0, index), src.shape[0]
+        )
+        argmax = torch.full(
+            out.shape, src.shape[0], dtype=torch.long, device=src.device
+        ).scatter_reduce(0, index, positions, "amin", include_self=True)
+    return out, argmax
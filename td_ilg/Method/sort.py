@@ -1,28 +1,22 @@
 import torch
 
+from td_ilg.Method.curve import toCurveKey
 
-def sortCenters(centers_quantized, encodings):
-    ind3 = torch.argsort(centers_quantized[:, :, 2], dim=1)
-    centers_quantized = torch.gather(
-        centers_quantized,
-        1,
-        ind3[:, :, None].expand(-1, -1, centers_quantized.shape[-1]),
-    )
-    encodings = torch.gather(encodings, 1, ind3)
 
-    _, ind2 = torch.sort(centers_quantized[:, :, 1], dim=1, stable=True)
-    centers_quantized = torch.gather(
-        centers_quantized,
-        1,
-        ind2[:, :, None].expand(-1, -1, centers_quantized.shape[-1]),
-    )
-    encodings = torch.gather(encodings, 1, ind2)
+def sortCenters(centers_quantized, encodings, order="xyz"):
+    """
+    centers_quantized: B x T x 3 bins < 256, encodings: B x T
+    sorts both by x, then y, then z with order="xyz", or along the Z-order or
+    Hilbert curve with order="morton" or "hilbert", with one argsort and one
+    gather per tensor
+    """
+    key = toCurveKey(centers_quantized.long(), order)
 
-    _, ind1 = torch.sort(centers_quantized[:, :, 0], dim=1, stable=True)
+    ind = torch.argsort(key, dim=1, stable=True)
     centers_quantized = torch.gather(
         centers_quantized,
         1,
-        ind1[:, :, None].expand(-1, -1, centers_quantized.shape[-1]),
+        ind[:, :, None].expand(-1, -1, centers_quantized.shape[-1]),
     )
-    encodings = torch.gather(encodings, 1, ind1)
+    encodings = torch.gather(encodings, 1, ind)
     return centers_quantized, encodings
@@ -1,6 +1,12 @@
 import torch.nn as nn
 
 from td_ilg.Model.GPT.causal_self_attention import CausalSelfAttention
+from td_ilg.Model.GPT.sdpa_causal_self_attention import SDPACausalSelfAttention
+
+ATTENTION_BACKENDS = {
+    "vanilla": CausalSelfAttention,
+    "sdpa": SDPACausalSelfAttention,
+}
 
 
 class Block(nn.Module):
@@ -10,7 +16,7 @@ class Block(nn.Module):
         super().__init__()
         self.ln1 = nn.LayerNorm(config.n_embd)
         self.ln2 = nn.LayerNorm(config.n_embd)
-        self.attn = CausalSelfAttention(config)
+        self.attn = ATTENTION_BACKENDS[config.attn_backend](config)
         self.mlp = nn.Sequential(
             nn.Linear(config.n_embd, 4 * config.n_embd),
             nn.GELU(),  # nice
@@ -18,12 +24,21 @@ class Block(nn.Module):
             nn.Dropout(config.resid_pdrop),
         )
 
-    def forward(self, x, layer_past=None, return_present=False):
+    def forward(
+        self, x, layer_past=None, return_present=False, kv_cache=None, layer_idx=None
+    ):
         # TODO: check that training still works
-        if return_present:
+        if return_present or kv_cache is not None:
             assert not self.training
         # layer past: tuple of length two with B, nh, T, hs
-        attn, present = self.attn(self.ln1(x), layer_past=layer_past)
+        # kv_cache: KVCache shared by all layers, updated in place at layer_idx
+        attn, present = self.attn(
+            self.ln1(x),
+            layer_past=layer_past,
+            return_present=layer_past is not None or return_present,
+            kv_cache=kv_cache,
+            layer_idx=layer_idx,
+        )
 
         x = x + attn
         x = x + self.mlp(self.ln2(x))
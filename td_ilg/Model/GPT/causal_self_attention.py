@@ -4,6 +4,8 @@ import logging
 import torch.nn as nn
 from torch.nn import functional as F
 
+from td_ilg.Model.GPT.kv_cache import updatePast
+
 logger = logging.getLogger(__name__)
 
 
@@ -28,14 +30,33 @@ class CausalSelfAttention(nn.Module):
         self.proj = nn.Linear(config.n_embd, config.n_embd)
         # causal mask to ensure that attention is only applied to the left in the input sequence
         mask = torch.tril(torch.ones(config.block_size, config.block_size))
+        if getattr(config, "attn_window", 0) > 0:
+            # sliding window, the attn_window - 1 previous positions are kept
+            mask = torch.triu(mask, diagonal=1 - config.attn_window)
+            # the attn_global first positions stay visible to every later position
+            attn_global = getattr(config, "attn_global", 0)
+            mask[:, :attn_global] = torch.tril(
+                torch.ones(config.block_size, config.block_size)
+            )[:, :attn_global]
         if hasattr(config, "n_unmasked"):
             mask[: config.n_unmasked, : config.n_unmasked] = 1
+        # built from the config, not saved, so checkpoints never override the window
         self.register_buffer(
-            "mask", mask.view(1, 1, config.block_size, config.block_size)
+            "mask",
+            mask.view(1, 1, config.block_size, config.block_size),
+            persistent=False,
         )
         self.n_head = config.n_head
 
-    def forward(self, x, layer_past=None):
+        self._register_load_state_dict_pre_hook(self._drop_mask_state_dict)
+
+    def _drop_mask_state_dict(self, state_dict, prefix, *args):
+        # checkpoints saved before the mask became non-persistent still hold it
+        state_dict.pop(prefix + "mask", None)
+
+    def forward(
+        self, x, layer_past=None, return_present=True, kv_cache=None, layer_idx=None
+    ):
         B, T, C = x.size()
 
         # calculate query, key, values for all heads in batch and move head forward to be the batch dim
@@ -49,16 +70,15 @@ class CausalSelfAttention(nn.Module):
             self.value(x).view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
         )  # (B, nh, T, hs)
 
-        present = torch.stack((k, v))
-        if layer_past is not None:
-            past_key, past_value = layer_past
-            k = torch.cat((past_key, k), dim=-2)
-            v = torch.cat((past_value, v), dim=-2)
+        k, v, present = updatePast(
+            k, v, layer_past, return_present, kv_cache, layer_idx
+        )
 
         # causal self-attention; Self-attend: (B, nh, T, hs) x (B, nh, hs, T) -> (B, nh, T, T)
         att = (q @ k.transpose(-2, -1)) * (1.0 / math.sqrt(k.size(-1)))
-        if layer_past is None:
-            att = att.masked_fill(self.mask[:, :, :T, :T] == 0, float("-inf"))
+        # queries sit at the last T of the L cached + new positions
+        L = k.size(-2)
+        att = att.masked_fill(self.mask[:, :, L - T : L, :L] == 0, float("-inf"))
 
         att = F.softmax(att, dim=-1)
         att = self.attn_drop(att)
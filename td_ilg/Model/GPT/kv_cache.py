@@ -0,0 +1,87 @@
+import torch
+
+
+class KVCache(object):
+    """
+    Preallocated key/value buffers for incremental decoding.
+    Keys and values of all layers live in one n_layer x 2 x B x nh x block_size x hs
+    tensor and new positions are written in place behind a per-layer length cursor,
+    so decoding a sequence never reallocates or copies the cache.
+    A cache of only the layers first_layer ... first_layer + n_layer - 1 is still
+    indexed by the global layer index, e.g. to hold the blocks of a single stage.
+    """
+
+    def __init__(
+        self,
+        n_layer,
+        batch_size,
+        n_head,
+        block_size,
+        head_size,
+        dtype=torch.float32,
+        device="cpu",
+        first_layer=0,
+    ):
+        self.kv = torch.zeros(
+            n_layer,
+            2,
+            batch_size,
+            n_head,
+            block_size,
+            head_size,
+            dtype=dtype,
+            device=device,
+        )
+        self.lengths = [0] * n_layer
+        self.first_layer = first_layer
+        return
+
+    @property
+    def block_size(self):
+        return self.kv.shape[-2]
+
+    def update(self, layer_idx, k, v):
+        # k, v: B x nh x T x hs, returns the keys and values of all cached positions
+        layer_idx -= self.first_layer
+        start = self.lengths[layer_idx]
+        end = start + k.shape[-2]
+        assert end <= self.block_size, f"{end} > block_size {self.block_size}"
+
+        self.kv[layer_idx, 0, :, :, start:end] = k
+        self.kv[layer_idx, 1, :, :, start:end] = v
+        self.lengths[layer_idx] = end
+        return self.kv[layer_idx, 0, :, :, :end], self.kv[layer_idx, 1, :, :, :end]
+
+    def truncate(self, length, start=None, end=None):
+        # drop every position from length on, the buffers are kept for reuse
+        # start, end: only truncate the layers start ... end - 1, all by default
+        start = 0 if start is None else start - self.first_layer
+        end = len(self.lengths) if end is None else end - self.first_layer
+        for i in range(start, end):
+            self.lengths[i] = min(self.lengths[i], length)
+        return True
+
+    def reset(self):
+        return self.truncate(0)
+
+
+def updatePast(
+    k, v, layer_past=None, return_present=True, kv_cache=None, layer_idx=None
+):
+    """
+    k, v: B x nh x T x hs keys and values of the new positions of an attention layer
+    returns the keys and values of all the positions to attend to, and the present
+    2 x B x nh x T x hs stack of the new ones, None when written to kv_cache
+    """
+    present = None
+    if kv_cache is not None:
+        # write the new keys and values in place, read back the whole prefix
+        k, v = kv_cache.update(layer_idx, k, v)
+    else:
+        if return_present:
+            present = torch.stack((k, v))
+        if layer_past is not None:
+            past_key, past_value = layer_past
+            k = torch.cat((past_key, k), dim=-2)
+            v = torch.cat((past_value, v), dim=-2)
+    return k, v, present
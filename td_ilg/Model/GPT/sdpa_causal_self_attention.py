@@ -0,0 +1,173 @@
+import torch
+import torch.nn as nn
+from torch.nn import functional as F
+
+from td_ilg.Model.GPT.kv_cache import updatePast
+
+
+class SDPACausalSelfAttention(nn.Module):
+    """
+    A multi-head masked self-attention layer with a single fused qkv projection,
+    backed by torch.nn.functional.scaled_dot_product_attention.
+    The causal mask is never materialized, so no block_size x block_size buffer is
+    registered, and checkpoints of CausalSelfAttention (separate key, query and
+    value projections plus the mask buffer) are converted when loaded.
+    With an attn_window, attention is computed blockwise over the window and the
+    attn_global first positions, so its cost grows linearly with the sequence.
+    """
+
+    def __init__(self, config):
+        super().__init__()
+        assert config.n_embd % config.n_head == 0
+        assert (
+            getattr(config, "n_unmasked", 0) == 0
+        ), "n_unmasked is only supported by the vanilla attention backend"
+        # query, key, value projections for all heads, fused
+        self.qkv = nn.Linear(config.n_embd, 3 * config.n_embd)
+        # regularization
+        self.attn_pdrop = config.attn_pdrop
+        self.resid_drop = nn.Dropout(config.resid_pdrop)
+        # output projection
+        self.proj = nn.Linear(config.n_embd, config.n_embd)
+        self.n_head = config.n_head
+        self.attn_window = getattr(config, "attn_window", 0)
+        self.attn_global = getattr(config, "attn_global", 0)
+
+        self._register_load_state_dict_pre_hook(self._fuse_qkv_state_dict)
+
+    def _fuse_qkv_state_dict(self, state_dict, prefix, *args):
+        if prefix + "query.weight" in state_dict:
+            for name in ["weight", "bias"]:
+                state_dict[prefix + "qkv." + name] = torch.cat(
+                    [
+                        state_dict.pop(prefix + "query." + name),
+                        state_dict.pop(prefix + "key." + name),
+                        state_dict.pop(prefix + "value." + name),
+                    ]
+                )
+        state_dict.pop(prefix + "mask", None)
+
+    def get_attn_mask(self, T, L, device):
+        # queries sit at the last T of the L cached + new positions
+        # returns the T x L boolean mask (None when not needed) and is_causal
+        if L == T:
+            return None, T > 1
+        if T > 1:
+            attn_mask = torch.ones(T, L, dtype=torch.bool, device=device)
+            return attn_mask.tril(diagonal=L - T), False
+        return None, False
+
+    def get_window_mask(self, query_pos, key_pos):
+        # positions broadcast to ... x T x L, returns the mask of the keys before each
+        # query that are inside its window or among the attn_global first positions
+        return (key_pos <= query_pos) & (
+            (key_pos > query_pos - self.attn_window) | (key_pos < self.attn_global)
+        )
+
+    def window_attention(self, q, k, v, dropout_p=0.0):
+        """
+        q: B x nh x T x hs queries of the last T of the L positions of k, v
+        only the global positions and the last attn_window + T - 1 positions are
+        read, e.g. a decoding step costs O(attn_global + attn_window)
+        """
+        T = q.size(-2)
+        L = k.size(-2)
+        G = min(self.attn_global, L)
+        start = max(G, L - T + 1 - self.attn_window)
+        key_pos = torch.arange(L, device=q.device)
+        if start > G:
+            key_pos = torch.cat([key_pos[:G], key_pos[start:]])
+            k = torch.cat([k[:, :, :G], k[:, :, start:]], dim=2)
+            v = torch.cat([v[:, :, :G], v[:, :, start:]], dim=2)
+
+        query_pos = torch.arange(L - T, L, device=q.device)
+        attn_mask = self.get_window_mask(query_pos[:, None], key_pos[None])
+        return F.scaled_dot_product_attention(
+            q, k, v, attn_mask=attn_mask, dropout_p=dropout_p
+        )
+
+    def block_window_attention(self, q, k, v, dropout_p=0.0):
+        """
+        window attention of T > attn_window queries at O(T * (attn_global + 2W))
+        memory and FLOPs, W = attn_window: the queries are split into blocks of W,
+        block c attends to the global positions and the 2W keys of blocks c - 1, c
+        """
+        B, nh, T, hs = q.shape
+        L = k.size(-2)
+        W = self.attn_window
+        G = min(self.attn_global, L)
+        n = (T + W - 1) // W
+
+        q = F.pad(q, (0, 0, 0, n * W - T)).view(B, nh, n, W, hs)
+        query_pos = torch.arange(L - T, L - T + n * W, device=q.device).view(n, W, 1)
+
+        # keys from position L - T - W on, zero padded below 0 and up to (n + 1) W
+        start = L - T - W
+        pad = (0, 0, max(0, -start), n * W - T)
+        local_k = F.pad(k[:, :, max(0, start) :], pad).unfold(2, 2 * W, W)
+        local_v = F.pad(v[:, :, max(0, start) :], pad).unfold(2, 2 * W, W)
+        local_pos = start + torch.arange(n * W + W, device=q.device).unfold(0, 2 * W, W)
+        # the global positions and the padding below 0 are never read as local keys
+        local_pos = local_pos.masked_fill(local_pos < G, L + n * W)
+
+        k = torch.cat(
+            [k[:, :, None, :G].expand(-1, -1, n, -1, -1), local_k.transpose(3, 4)],
+            dim=3,
+        )
+        v = torch.cat(
+            [v[:, :, None, :G].expand(-1, -1, n, -1, -1), local_v.transpose(3, 4)],
+            dim=3,
+        )
+        key_pos = torch.cat(
+            [torch.arange(G, device=q.device).expand(n, -1), local_pos], dim=1
+        )
+        attn_mask = self.get_window_mask(query_pos, key_pos[:, None])  # n x W x K
+
+        # blocks are folded into the heads, K = G + 2W keys per block
+        y = F.scaled_dot_product_attention(
+            q.reshape(B, nh * n, W, hs),
+            k.reshape(B, nh * n, G + 2 * W, hs),
+            v.reshape(B, nh * n, G + 2 * W, hs),
+            attn_mask=attn_mask.repeat(nh, 1, 1),
+            dropout_p=dropout_p,
+        )
+        return y.view(B, nh, n * W, hs)[:, :, :T]
+
+    def forward(
+        self, x, layer_past=None, return_present=True, kv_cache=None, layer_idx=None
+    ):
+        B, T, C = x.size()
+
+        # calculate query, key, values for all heads in batch and move head forward to be the batch dim
+        q, k, v = self.qkv(x).split(C, dim=2)
+        # (B, nh, T, hs)
+        q = q.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        k = k.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+        v = v.view(B, T, self.n_head, C // self.n_head).transpose(1, 2)
+
+        k, v, present = updatePast(
+            k, v, layer_past, return_present, kv_cache, layer_idx
+        )
+
+        dropout_p = self.attn_pdrop if self.training else 0.0
+        if self.attn_window > 0:
+            if T > self.attn_window:
+                y = self.block_window_attention(q, k, v, dropout_p)
+            else:
+                y = self.window_attention(q, k, v, dropout_p)
+        else:
+            attn_mask, is_causal = self.get_attn_mask(T, k.size(-2), x.device)
+            y = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                attn_mask=attn_mask,
+                dropout_p=dropout_p,
+                is_causal=is_causal,
+            )
+        # re-assemble all head outputs side by side
+        y = y.transpose(1, 2).contiguous().view(B, T, C)
+
+        # output projection
+        y = self.resid_drop(self.proj(y))
+        return y, present
@@ -13,6 +13,7 @@ class Attention(nn.Module):
         attn_drop=0.0,
         proj_drop=0.0,
         attn_head_dim=None,
+        use_sdpa=True,
     ):
         super().__init__()
         self.num_heads = num_heads
@@ -26,6 +27,7 @@ class Attention(nn.Module):
         if qkv_bias:
             self.q_bias = nn.Parameter(torch.zeros(all_head_dim))
             self.v_bias = nn.Parameter(torch.zeros(all_head_dim))
+            self.register_buffer("k_bias", torch.zeros(all_head_dim), persistent=False)
         else:
             self.q_bias = None
             self.v_bias = None
@@ -34,23 +36,54 @@ class Attention(nn.Module):
         self.proj = nn.Linear(all_head_dim, dim)
         self.proj_drop = nn.Dropout(proj_drop)
 
+        # fused attention never materializes the B x heads x N x N attention matrix
+        self.use_sdpa = use_sdpa and hasattr(F, "scaled_dot_product_attention")
+        self.qkv_bias_cache = None
+
+    def get_qkv_bias(self):
+        if self.q_bias is None:
+            return None
+
+        if torch.is_grad_enabled() and (
+            self.q_bias.requires_grad or self.v_bias.requires_grad
+        ):
+            return torch.cat((self.q_bias, self.k_bias, self.v_bias))
+
+        # rebuilt only when the biases are updated, loaded or moved
+        key = (
+            self.q_bias._version,
+            self.v_bias._version,
+            self.q_bias.data_ptr(),
+            self.v_bias.data_ptr(),
+        )
+        if self.qkv_bias_cache is None or self.qkv_bias_cache[0] != key:
+            qkv_bias = torch.cat((self.q_bias, self.k_bias, self.v_bias)).detach()
+            self.qkv_bias_cache = (key, qkv_bias)
+        return self.qkv_bias_cache[1]
+
     def forward(self, x):
         B, N, C = x.shape
-        qkv_bias = None
-        if self.q_bias is not None:
-            qkv_bias = torch.cat(
-                (
-                    self.q_bias,
-                    torch.zeros_like(self.v_bias, requires_grad=False),
-                    self.v_bias,
-                )
-            )
+        qkv_bias = self.get_qkv_bias()
         # qkv = self.qkv(x).reshape(B, N, 3, self.num_heads, C // self.num_heads).permute(2, 0, 3, 1, 4)
         qkv = F.linear(input=x, weight=self.qkv.weight, bias=qkv_bias)
         qkv = qkv.reshape(B, N, 3, self.num_heads, -1).permute(2, 0, 3, 1, 4)
         # make torchscript happy (cannot use tensor as tuple)
         q, k, v = qkv[0], qkv[1], qkv[2]
 
+        if self.use_sdpa:
+            # sdpa scales by head_dim**-0.5, its scale argument needs torch >= 2.1
+            q = q * (self.scale * q.shape[-1] ** 0.5)
+            x = F.scaled_dot_product_attention(
+                q,
+                k,
+                v,
+                dropout_p=self.attn_drop.p if self.training else 0.0,
+            )
+            x = x.transpose(1, 2).reshape(B, N, -1)
+            x = self.proj(x)
+            x = self.proj_drop(x)
+            return x
+
         q = q * self.scale
         attn = q @ k.transpose(-2, -1)
 
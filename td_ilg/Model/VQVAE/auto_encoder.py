@@ -8,12 +8,12 @@ from td_ilg.Model.VQVAE.vector_quantizer2 import VectorQuantizer2
 
 
 class AutoEncoder(nn.Module):
-    def __init__(self, N, K=512, dim=256, M=2048):
+    def __init__(self, N, K=512, dim=256, M=2048, knn=0):
         super().__init__()
 
         self.encoder = Encoder(N=N, dim=dim, M=M)
 
-        self.decoder = Decoder(latent_channel=dim)
+        self.decoder = Decoder(latent_channel=dim, knn=knn)
 
         self.codebook = VectorQuantizer2(K, dim)
 
@@ -24,10 +24,11 @@ class AutoEncoder(nn.Module):
     def no_weight_decay(self):
         return {}
 
-    def encode(self, x, bins=256):
+    def encode(self, x, bins=256, idx=None, knn_idx=None):
+        # idx, knn_idx: optional cached fps and knn indices, see Encoder.forward
         B, _, _ = x.shape
 
-        z_e_x, centers = self.encoder(x)  # B x T x C, B x T x 3
+        z_e_x, centers = self.encoder(x, idx, knn_idx)  # B x T x C, B x T x 3
 
         centers_quantized = ((centers + 1) / 2 * (bins - 1)).long()
 
@@ -54,3 +55,21 @@ class AutoEncoder(nn.Module):
         logits, sigma = self.decoder(z_q_x_st, centers, points)
 
         return logits, z_e_x, z_q_x, sigma, loss_vq, perplexity
+
+    @torch.no_grad()
+    def bake(self, x, resolution=64, sparse_radius=0.0, cache_file_path=None):
+        # x: B x M x 3 surface points, see Decoder.bake
+        _, z_q_x_st, centers_quantized, _, _, _ = self.encode(x)
+        centers = centers_quantized.float() / 255.0 * 2 - 1
+
+        return self.decoder.bake(
+            self.decoder.prepare(z_q_x_st, centers),
+            resolution=resolution,
+            sparse_radius=sparse_radius,
+            cache_file_path=cache_file_path,
+        )
+
+    @torch.no_grad()
+    def query_baked(self, baked, points):
+        logits, _ = self.decoder.query_baked(baked, points)
+        return logits
@@ -21,6 +21,7 @@ class Block(nn.Module):
         act_layer=nn.GELU,
         norm_layer=nn.LayerNorm,
         attn_head_dim=None,
+        use_sdpa=True,
     ):
         super().__init__()
         self.norm1 = norm_layer(dim)
@@ -32,6 +33,7 @@ class Block(nn.Module):
             attn_drop=attn_drop,
             proj_drop=drop,
             attn_head_dim=attn_head_dim,
+            use_sdpa=use_sdpa,
         )
         # NOTE: drop path for stochastic depth, we shall see if this is better than dropout here
         self.drop_path = DropPath(drop_path) if drop_path > 0.0 else nn.Identity()
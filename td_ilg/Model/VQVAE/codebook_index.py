@@ -0,0 +1,113 @@
+import torch
+
+
+class CodebookIndex(object):
+    """
+    Inverted file index over a codebook for approximate nearest-code search.
+    A k-means coarse quantizer splits the codes into n_list lists, a query is only
+    compared to the codes of its n_probe nearest lists. More probes trade speed for
+    recall, n_probe = n_list is exact.
+    """
+
+    def __init__(self, n_list=None, n_probe=8, n_iter=10, seed=0):
+        # number of lists, sqrt(n_e) by default
+        self.n_list = n_list
+        self.n_probe = n_probe
+        self.n_iter = n_iter
+        self.seed = seed
+
+        self.centroids = None
+        # codes of each list, sorted by list
+        self.list_codes = None
+        self.list_sizes = None
+        return
+
+    @staticmethod
+    def assign(points, centroids, chunk_size=8192):
+        # points: M x D, returns the M indices of the nearest centroids
+        centroid_norms = torch.sum(centroids**2, dim=1)
+        return torch.cat(
+            [
+                torch.argmin(
+                    torch.addmm(centroid_norms, points_chunk, centroids.t(), alpha=-2),
+                    dim=1,
+                )
+                for points_chunk in points.split(chunk_size, dim=0)
+            ]
+        )
+
+    @torch.no_grad()
+    def build(self, weight):
+        # weight: n_e x D codebook, k-means with Lloyd iterations
+        weight = weight.detach()
+        n_e = weight.shape[0]
+        n_list = self.n_list
+        if n_list is None:
+            n_list = max(1, int(round(n_e**0.5)))
+        n_list = min(n_list, n_e)
+
+        generator = torch.Generator().manual_seed(self.seed)
+        init_idx = torch.randperm(n_e, generator=generator)[:n_list]
+        centroids = weight[init_idx.to(weight.device)].clone()
+
+        for _ in range(self.n_iter):
+            assignment = self.assign(weight, centroids)
+            counts = torch.bincount(assignment, minlength=n_list)
+            sums = torch.zeros_like(centroids).index_add_(0, assignment, weight)
+            # empty lists keep their previous centroid
+            non_empty = counts > 0
+            centroids[non_empty] = sums[non_empty] / counts[non_empty, None].to(
+                weight.dtype
+            )
+
+        # empty lists are dropped, so every probed list has candidates
+        assignment = self.assign(weight, centroids)
+        counts = torch.bincount(assignment, minlength=n_list)
+        if not bool((counts > 0).all()):
+            centroids = centroids[counts > 0]
+            assignment = self.assign(weight, centroids)
+        n_list = centroids.shape[0]
+
+        self.centroids = centroids
+        self.list_codes = torch.argsort(assignment)
+        self.list_sizes = torch.bincount(assignment, minlength=n_list).tolist()
+        return True
+
+    @torch.no_grad()
+    def search(self, z_flattened, weight, codebook_norms):
+        """
+        z_flattened: M x D queries, weight: n_e x D codebook the index was built from,
+        codebook_norms: n_e squared norms of the codes
+        returns the M indices of the nearest codes among the probed lists
+        """
+        M = z_flattened.shape[0]
+        n_probe = min(self.n_probe, self.centroids.shape[0])
+        centroid_norms = torch.sum(self.centroids**2, dim=1)
+        centroid_dist = torch.addmm(
+            centroid_norms, z_flattened, self.centroids.t(), alpha=-2
+        )
+        _, probe = torch.topk(centroid_dist, n_probe, dim=1, largest=False)  # M x P
+
+        # queries grouped by probed list, so each list is searched with one addmm
+        probe = probe.flatten()
+        order = torch.argsort(probe)
+        query_counts = torch.bincount(probe, minlength=len(self.list_sizes)).tolist()
+        list_queries = torch.split(order // n_probe, query_counts)
+        list_codes = torch.split(self.list_codes, self.list_sizes)
+
+        best_dist = z_flattened.new_full((M,), float("inf"))
+        best_idx = torch.zeros(M, dtype=torch.long, device=z_flattened.device)
+        for query_idx, code_idx in zip(list_queries, list_codes):
+            if query_idx.shape[0] == 0 or code_idx.shape[0] == 0:
+                continue
+            dist = torch.addmm(
+                codebook_norms[code_idx],
+                z_flattened[query_idx],
+                weight[code_idx].t(),
+                alpha=-2,
+            )
+            min_dist, min_idx = torch.min(dist, dim=1)
+            better = min_dist < best_dist[query_idx]
+            best_dist[query_idx[better]] = min_dist[better]
+            best_idx[query_idx[better]] = code_idx[min_idx[better]]
+        return best_idx
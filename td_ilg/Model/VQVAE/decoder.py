@@ -1,3 +1,4 @@
+import os
 import torch
 import numpy as np
 import torch.nn as nn
@@ -7,14 +8,23 @@ from torch.nn import Linear as Lin
 from torch.nn import Sequential as Seq
 
 from td_ilg.Method.embed import embed
+from td_ilg.Method.model import getModelVersion
+from td_ilg.Method.occupancy import toGridPoints
+from td_ilg.Data.lru_cache import LRUCache
 from td_ilg.Model.VQVAE.embedding import Embedding
 from td_ilg.Model.VQVAE.vision_transformer import VisionTransformer
 
 
 class Decoder(nn.Module):
-    def __init__(self, latent_channel=192):
+    def __init__(self, latent_channel=192, knn=0, query_chunk_size=16384):
         super().__init__()
 
+        # interpolate the latents of the knn nearest centers of each query,
+        # 0 uses all centers
+        self.knn = knn
+        # queries interpolated at once by the knn mode
+        self.query_chunk_size = query_chunk_size
+
         self.fc = Embedding(latent_channel=latent_channel)
         self.log_sigma = nn.Parameter(torch.FloatTensor([3.0]))
         # self.register_buffer('log_sigma', torch.Tensor([-3.0]))
@@ -65,25 +75,233 @@ class Decoder(nn.Module):
             init_values=0.0,
         )
 
+        # shape key -> handle of prepare, kept across repeated queries of a shape
+        self.latent_cache = None
+
+    def enable_latent_cache(self, max_size=16):
+        self.latent_cache = LRUCache(max_size)
+        return True
+
+    def get_model_version(self):
+        return getModelVersion(self, self.log_sigma)
+
+    def prepare(self, latents, centers, key=None):
+        """
+        run the transformer over the latents of a shape once, the returned handle
+        is evaluated at any number of query chunks by query
+        latents: B x T x C, centers: B x T x 3
+        key: optional hashable id of the shape, the handle is then kept in the
+        latent cache (see enable_latent_cache), meant for inference
+        """
+        if key is not None and self.latent_cache is not None:
+            key = (key, self.get_model_version())
+            handle = self.latent_cache.get(key)
+            if handle is not None:
+                return handle
+
+        embeddings = embed(centers, self.basis)
+        embeddings = self.embed(torch.cat([centers, embeddings], dim=2))
+        latents = self.transformer(latents, embeddings)
+
+        handle = (latents, centers)
+        if key is not None and self.latent_cache is not None:
+            self.latent_cache.put(key, handle)
+        return handle
+
     def forward(self, latents, centers, samples):
         # kernel average
         # samples: B x N x 3
         # latents: B x T x 320
         # centers: B x T x 3
+        return self.query(self.prepare(latents, centers), samples)
 
-        embeddings = embed(centers, self.basis)
-        embeddings = self.embed(torch.cat([centers, embeddings], dim=2))
-        latents = self.transformer(latents, embeddings)
+    def query(self, handle, samples):
+        # handle: returned by prepare, samples: B x N x 3
+        latents, centers = handle
 
-        pdist = (
-            (samples[:, :, None] - centers[:, None]).square().sum(dim=3)
-        )  # B x N x T
         sigma = torch.exp(self.log_sigma)
-        weight = F.softmax(-pdist * sigma, dim=2)
+        latents = self.interpolate(latents, centers, samples, sigma)  # B x N x C
+        preds = self.fc(samples, latents).squeeze(2)
+
+        return preds, sigma
+
+    @torch.no_grad()
+    def bake(
+        self,
+        handle,
+        resolution=64,
+        sparse_radius=0.0,
+        chunk_size=50000,
+        cache_file_path=None,
+    ):
+        """
+        sample the interpolated latent field of prepared shapes on the
+        (resolution + 1)^3 grid of [-1, 1]^3, query_baked then answers queries by a
+        trilinear lookup plus fc instead of the kernel over all centers.
+        sparse_radius > 0 only bakes and stores the grid points within sparse_radius
+        of a center of any shape of the batch, as sorted flat grid indices plus their
+        features, queries outside the baked cells of their shape fall back to the
+        exact interpolation
+        cache_file_path: loaded if it exists and was baked with the same resolution
+        and sparse_radius, saved to otherwise. it is not checked against the model
+        weights, use one file per shape and checkpoint
+        """
+        if cache_file_path is not None and os.path.exists(cache_file_path):
+            baked = torch.load(cache_file_path, map_location=handle[0].device)
+            if (
+                baked.get("resolution") == resolution
+                and baked.get("sparse_radius") == sparse_radius
+            ):
+                return baked
+
+            print("[WARN][Decoder::bake]")
+            print("\t cache file was baked with other settings, rebake it!")
+            print("\t cache_file_path:", cache_file_path)
+
+        latents, centers = handle
+        B, _, C = latents.shape
+        sigma = torch.exp(self.log_sigma)
+        points = toGridPoints(resolution, latents.device)  # M x 3
+
+        point_idx = None
+        active = None
+        if sparse_radius > 0:
+            mask = torch.cat(
+                [
+                    torch.cdist(points_chunk[None].expand(B, -1, -1), centers).amin(
+                        dim=2
+                    )
+                    <= sparse_radius
+                    for points_chunk in points.split(chunk_size, dim=0)
+                ],
+                dim=1,
+            )  # B x M
+            point_idx = mask.any(dim=0).nonzero()[:, 0]  # P, sorted
+            active = mask[:, point_idx]  # B x P, baked for each shape
+            points = points[point_idx]
+
+        features = latents.new_empty(B, points.shape[0], C)
+        for start in range(0, points.shape[0], chunk_size):
+            points_chunk = points[start : start + chunk_size]
+            features[:, start : start + points_chunk.shape[0]] = self.interpolate(
+                latents, centers, points_chunk[None].expand(B, -1, -1), sigma
+            )
+
+        baked = {
+            "resolution": resolution,
+            "sparse_radius": sparse_radius,
+            # flat x major indices of the baked grid points, None when all are
+            "point_idx": point_idx,
+            "active": active,
+            "features": features,  # B x P x C
+            "latents": latents,
+            "centers": centers,
+        }
+
+        if cache_file_path is not None:
+            cache_folder_path = os.path.dirname(cache_file_path)
+            if cache_folder_path != "":
+                os.makedirs(cache_folder_path, exist_ok=True)
+            torch.save(baked, cache_file_path)
+        return baked
+
+    def query_baked(self, baked, samples):
+        # baked: returned by bake, samples: B x N x 3
+        sigma = torch.exp(self.log_sigma)
+        resolution = baked["resolution"]
+        point_idx = baked["point_idx"]
+        features = baked["features"]
+
+        if point_idx is not None and point_idx.shape[0] == 0:
+            latents = self.interpolate(
+                baked["latents"], baked["centers"], samples, sigma
+            )
+            return self.fc(samples, latents).squeeze(2), sigma
+
+        # trilinear interpolation over the 8 corners of the cell of each sample,
+        # samples outside [-1, 1]^3 use the border cells
+        grid_coords = (samples.clamp(-1.0, 1.0) + 1.0) * (0.5 * resolution)
+        cells = grid_coords.floor().clamp(max=resolution - 1)
+        fracs = grid_coords - cells
+        cells = cells.long()  # B x N x 3
+
+        batch_idx = torch.arange(samples.shape[0], device=samples.device)[:, None]
+        latents = 0.0
+        missed = None
+        for corner in range(8):
+            offsets = [(corner >> 2) & 1, (corner >> 1) & 1, corner & 1]
+            weight = 1.0
+            idx = 0
+            for axis, offset in enumerate(offsets):
+                frac = fracs[:, :, axis]
+                weight = weight * (frac if offset else 1.0 - frac)
+                idx = idx * (resolution + 1) + cells[:, :, axis] + offset  # B x N
+
+            if point_idx is None:
+                slot = idx
+            else:
+                slot = torch.searchsorted(point_idx, idx).clamp(
+                    max=point_idx.shape[0] - 1
+                )
+                # a query is baked when all the corners of its cell are
+                baked_corner = (point_idx[slot] == idx) & baked["active"][
+                    batch_idx, slot
+                ]
+                corner_missed = ~baked_corner & (weight > 0)
+                missed = corner_missed if missed is None else missed | corner_missed
+
+            latents = latents + weight[:, :, None] * features[batch_idx, slot]
+
+        if missed is not None:
+            sample_idx = missed.any(dim=0).nonzero()[:, 0]
+            if sample_idx.shape[0] > 0:
+                exact_latents = self.interpolate(
+                    baked["latents"], baked["centers"], samples[:, sample_idx], sigma
+                )
+                latents[:, sample_idx] = torch.where(
+                    missed[:, sample_idx, None],
+                    exact_latents,
+                    latents[:, sample_idx],
+                )
 
-        latents = torch.sum(
-            weight[:, :, :, None] * latents[:, None, :, :], dim=2
-        )  # B x N x 128
         preds = self.fc(samples, latents).squeeze(2)
 
         return preds, sigma
+
+    def interpolate(self, latents, centers, samples, sigma):
+        # latents: B x T x C, centers: B x T x 3, samples: B x N x 3
+        if self.knn <= 0 or self.knn >= centers.shape[1]:
+            pdist = (
+                (samples[:, :, None] - centers[:, None]).square().sum(dim=3)
+            )  # B x N x T
+            weight = F.softmax(-pdist * sigma, dim=2)
+            return torch.bmm(weight, latents)
+
+        batch_idx = torch.arange(latents.shape[0], device=latents.device)
+        batch_idx = batch_idx[:, None, None]
+        centers_square = centers.square().sum(dim=2)[:, None]  # B x 1 x T
+
+        interpolated_latents = []
+        for samples_chunk in samples.split(self.query_chunk_size, dim=1):
+            # |s - c|^2 = |s|^2 + |c|^2 - 2 s.c, only used to search the neighbours
+            pdist = torch.baddbmm(
+                samples_chunk.square().sum(dim=2, keepdim=True) + centers_square,
+                samples_chunk,
+                centers.transpose(1, 2),
+                alpha=-2,
+            )  # B x n x T
+            knn_idx = torch.topk(pdist, self.knn, dim=2, largest=False)[1]
+
+            knn_dist = (
+                (samples_chunk[:, :, None] - centers[batch_idx, knn_idx])
+                .square()
+                .sum(dim=3)
+            )  # B x n x k
+            weight = F.softmax(-knn_dist * sigma, dim=2)
+
+            # only the k nearest latents of each query are gathered, B x n x k x C
+            knn_latents = latents[batch_idx, knn_idx]
+            interpolated_latents.append(
+                torch.einsum("bnk,bnkc->bnc", weight, knn_latents)
+            )
+        return torch.cat(interpolated_latents, dim=1)
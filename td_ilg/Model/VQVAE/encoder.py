@@ -7,15 +7,19 @@ from torch.nn import Linear as Lin
 from torch.nn import Sequential as Seq
 from torch.nn.utils import weight_norm
 
-from torch_cluster import fps, knn
+try:
+    from torch_cluster import fps, knn
+except ImportError:
+    from td_ilg.Method.cluster import fps, knn
 
 from td_ilg.Method.embed import embed
+from td_ilg.Method.neighbour import toEdgeIndex, toNeighbourNum
 from td_ilg.Model.VQVAE.vision_transformer import VisionTransformer
 from td_ilg.Model.VQVAE.point_conv import PointConv
 
 
 class Encoder(nn.Module):
-    def __init__(self, N, dim=128, M=2048):
+    def __init__(self, N, dim=128, M=2048, edge_chunk_size=0):
         super().__init__()
 
         self.embed = Seq(Lin(48 + 3, dim))  # , nn.GELU(), Lin(128, 128))
@@ -59,6 +63,7 @@ class Encoder(nn.Module):
             global_nn=Seq(
                 weight_norm(Lin(256, 256)), ReLU(True), weight_norm(Lin(256, dim))
             ),
+            edge_chunk_size=edge_chunk_size,
         )
 
         self.transformer = VisionTransformer(
@@ -77,10 +82,13 @@ class Encoder(nn.Module):
 
         self.M = M
         self.ratio = N / M
-        self.k = 32
+        self.k = toNeighbourNum(M, N, "vqvae")
 
-    def forward(self, pc):
+    def forward(self, pc, idx=None, knn_idx=None):
         # pc: B x N x D
+        # idx: B x T, knn_idx: B x T x k, cached fps and knn indices into each
+        # point cloud, e.g. from a NeighbourCacher cache, the knn is computed when
+        # only idx is given
         B, N, D = pc.shape
         assert N == self.M
 
@@ -91,12 +99,25 @@ class Encoder(nn.Module):
 
         pos = flattened
 
-        idx = fps(pos, batch, ratio=self.ratio)  # 0.0625
-
-        row, col = knn(pos, pos[idx], self.k, batch, batch[idx])
-        edge_index = torch.stack([col, row], dim=0)
-
-        x = self.conv(pos, pos[idx], edge_index, self.basis)
+        if knn_idx is not None:
+            assert idx is not None
+            assert (
+                knn_idx.shape[-1] == self.k
+            ), "the cached graph was built with another k"
+            idx, edge_index = toEdgeIndex(idx.to(pc.device), knn_idx, N)
+        else:
+            if idx is None:
+                idx = fps(pos, batch, ratio=self.ratio)  # 0.0625
+            else:
+                # cached samples, offset into the flattened batch
+                idx = torch.as_tensor(idx, device=pc.device)
+                offsets = torch.arange(B, device=pc.device)[:, None] * N
+                idx = (idx + offsets).view(-1)
+
+            row, col = knn(pos, pos[idx], self.k, batch, batch[idx])
+            edge_index = torch.stack([col, row], dim=0)
+
+        x = self.conv(pos, pos[idx], edge_index, self.basis, dim_size=idx.shape[0])
         pos, batch = pos[idx], batch[idx]
 
         x = x.view(B, -1, x.shape[-1])
@@ -1,16 +1,23 @@
 import torch
-from torch_scatter import scatter_max
+from torch.utils.checkpoint import checkpoint
+
+try:
+    from torch_scatter import scatter_max
+except ImportError:
+    from td_ilg.Method.scatter import scatter_max
 
 
 class PointConv(torch.nn.Module):
-    def __init__(self, local_nn=None, global_nn=None):
+    def __init__(self, local_nn=None, global_nn=None, edge_chunk_size=0):
         super(PointConv, self).__init__()
         self.local_nn = local_nn
         self.global_nn = global_nn
+        # edges passed through local_nn and reduced at once, 0 processes all edges
+        # together. chunks cover disjoint destinations and are recomputed in the
+        # backward pass, so the per-edge features are bounded with autograd too
+        self.edge_chunk_size = edge_chunk_size
 
-    def forward(self, pos, pos_dst, edge_index, basis=None):
-        row, col = edge_index
-
+    def message(self, pos, pos_dst, row, col, basis=None):
         out = pos[row] - pos_dst[col]
 
         if basis is not None:
@@ -20,8 +27,67 @@ class PointConv(torch.nn.Module):
 
         if self.local_nn is not None:
             out = self.local_nn(out)
+        return out
+
+    def reduce(self, pos, pos_dst, row, col, basis=None, dim_size=None, dst_start=0):
+        # reduces into the dim_size destinations from dst_start on
+        out = self.message(pos, pos_dst, row, col, basis)
+        out, _ = scatter_max(out, col - dst_start, dim=0, dim_size=dim_size)
+        return out
+
+    def forward(self, pos, pos_dst, edge_index, basis=None, dim_size=None):
+        # dim_size: number of destination points, pos_dst.shape[0] by default
+        row, col = edge_index
+
+        if dim_size is None:
+            dim_size = pos_dst.shape[0]
+
+        if self.edge_chunk_size <= 0 or row.shape[0] <= self.edge_chunk_size:
+            out = self.reduce(pos, pos_dst, row, col, basis, dim_size)
+        else:
+            # group the edges by destination, each chunk reduces a range of about
+            # edge_chunk_size / mean degree destinations on its own
+            col, order = torch.sort(col, stable=True)
+            row = row[order]
+            dst_chunk_size = max(1, self.edge_chunk_size * dim_size // row.shape[0])
+            dst_starts = list(range(0, dim_size, dst_chunk_size)) + [dim_size]
+            edge_starts = torch.searchsorted(
+                col, torch.tensor(dst_starts, device=col.device)
+            ).tolist()
 
-        out, _ = scatter_max(out, col, dim=0, dim_size=col.max().item() + 1)
+            outs = []
+            for i in range(len(dst_starts) - 1):
+                row_chunk = row[edge_starts[i] : edge_starts[i + 1]]
+                col_chunk = col[edge_starts[i] : edge_starts[i + 1]]
+                chunk_dim_size = dst_starts[i + 1] - dst_starts[i]
+                if torch.is_grad_enabled():
+                    # only the inputs and the reduced features of the chunk are kept
+                    outs.append(
+                        checkpoint(
+                            self.reduce,
+                            pos,
+                            pos_dst,
+                            row_chunk,
+                            col_chunk,
+                            basis,
+                            chunk_dim_size,
+                            dst_starts[i],
+                            use_reentrant=False,
+                        )
+                    )
+                else:
+                    outs.append(
+                        self.reduce(
+                            pos,
+                            pos_dst,
+                            row_chunk,
+                            col_chunk,
+                            basis,
+                            chunk_dim_size,
+                            dst_starts[i],
+                        )
+                    )
+            out = torch.cat(outs, dim=0)
 
         if self.global_nn is not None:
             out = self.global_nn(out)
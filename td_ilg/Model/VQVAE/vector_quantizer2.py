@@ -1,7 +1,8 @@
 import torch
 import numpy as np
 import torch.nn as nn
-from einops import rearrange
+
+from td_ilg.Model.VQVAE.codebook_index import CodebookIndex
 
 
 class VectorQuantizer2(nn.Module):
@@ -23,12 +24,15 @@ class VectorQuantizer2(nn.Module):
         unknown_index="random",
         sane_index_shape=False,
         legacy=True,
+        chunk_size=8192,
     ):
         super().__init__()
         self.n_e = n_e
         self.e_dim = e_dim
         self.beta = beta
         self.legacy = legacy
+        # rows of z searched at once, bounds the distance matrix to chunk_size x n_e
+        self.chunk_size = chunk_size
 
         self.embedding = nn.Embedding(self.n_e, self.e_dim)
         # self.embedding.weight.data.uniform_(-1.0 / self.n_e, 1.0 / self.n_e)
@@ -51,14 +55,129 @@ class VectorQuantizer2(nn.Module):
 
         self.sane_index_shape = sane_index_shape
 
+        # number of times each code was selected since the last reset_code_usage
+        self.register_buffer(
+            "code_usage", torch.zeros(self.n_e, dtype=torch.long), persistent=False
+        )
+        # squared codebook norms and the weight version they were computed for
+        self._codebook_norms = None
+        self._codebook_norms_key = None
+        # optional approximate search index, used outside of training
+        self.codebook_index = None
+        self._codebook_index_key = None
+        # code index -> position in used (-1 when unused), built from used
+        self._remap_table = None
+        self._remap_table_key = None
+
+    def reset_code_usage(self):
+        self.code_usage.zero_()
+        return True
+
+    def get_codebook_key(self):
+        # changes whenever the codebook is updated in place, loaded or moved
+        weight = self.embedding.weight
+        return (weight._version, weight.data_ptr(), weight.dtype, weight.device)
+
+    @torch.no_grad()
+    def get_codebook_norms(self):
+        # |e|^2 of every code, recomputed only when the weights change
+        key = self.get_codebook_key()
+        if self._codebook_norms_key != key:
+            self._codebook_norms = torch.sum(self.embedding.weight.detach() ** 2, dim=1)
+            self._codebook_norms_key = key
+        return self._codebook_norms
+
+    def enable_codebook_index(self, n_list=None, n_probe=8, n_iter=10):
+        # approximate nearest-code search for inference and offline tokenization
+        self.codebook_index = CodebookIndex(n_list, n_probe, n_iter)
+        self._codebook_index_key = None
+        return True
+
+    def disable_codebook_index(self):
+        self.codebook_index = None
+        self._codebook_index_key = None
+        return True
+
+    @torch.no_grad()
+    def get_codebook_index(self):
+        # the index is rebuilt lazily on the first search after the codebook changed
+        key = self.get_codebook_key()
+        if self._codebook_index_key != key:
+            self.codebook_index.build(self.embedding.weight)
+            self._codebook_index_key = key
+        return self.codebook_index
+
+    @torch.no_grad()
+    def find_nearest_codes(self, z_flattened, approximate=None):
+        """
+        z_flattened: M x e_dim, returns the M indices of the nearest codes
+        approximate: search the codebook index, by default when it is enabled
+        and the module is not training
+        """
+        if approximate is None:
+            approximate = self.codebook_index is not None and not self.training
+
+        weight = self.embedding.weight.detach()
+        codebook_norms = self.get_codebook_norms()
+        if approximate:
+            return self.get_codebook_index().search(
+                z_flattened.detach(), weight, codebook_norms
+            )
+
+        # |z - e|^2 = |z|^2 + |e|^2 - 2 e * z, |z|^2 does not change the argmin
+        return torch.cat(
+            [
+                torch.argmin(
+                    torch.addmm(codebook_norms, z_chunk, weight.t(), alpha=-2), dim=1
+                )
+                for z_chunk in z_flattened.detach().split(self.chunk_size, dim=0)
+            ]
+        )
+
+    @torch.no_grad()
+    def measure_index_recall(self, z):
+        # fraction of rows of z for which the codebook index finds the exact nearest code
+        z_flattened = z.reshape(-1, self.e_dim)
+        exact_indices = self.find_nearest_codes(z_flattened, approximate=False)
+        approximate_indices = self.find_nearest_codes(z_flattened, approximate=True)
+        return (exact_indices == approximate_indices).float().mean().item()
+
+    @torch.no_grad()
+    def get_perplexity(self, min_encoding_indices):
+        # exp of the entropy of the code histogram of this batch
+        counts = torch.bincount(min_encoding_indices, minlength=self.n_e)
+        self.code_usage += counts
+        probs = counts.float() / min_encoding_indices.shape[0]
+        return torch.exp(-torch.sum(probs * torch.log(probs + 1e-10)))
+
+    @torch.no_grad()
+    def get_remap_table(self):
+        # rebuilt only when the used buffer is loaded or moved
+        used = self.used
+        key = (used._version, used.data_ptr(), used.device)
+        if self._remap_table_key != key:
+            used = used.long()
+            table = torch.full(
+                (max(self.n_e, int(used.max()) + 1),),
+                used.shape[0],
+                dtype=torch.long,
+                device=used.device,
+            )
+            # the first position of a code listed twice wins, as with argmax
+            table.scatter_reduce_(
+                0, used, torch.arange(used.shape[0], device=used.device), "amin"
+            )
+            table[table == used.shape[0]] = -1
+            self._remap_table = table
+            self._remap_table_key = key
+        return self._remap_table
+
     def remap_to_used(self, inds):
         ishape = inds.shape
         assert len(ishape) > 1
         inds = inds.reshape(ishape[0], -1)
-        used = self.used.to(inds)
-        match = (inds[:, :, None] == used[None, None, ...]).long()
-        new = match.argmax(-1)
-        unknown = match.sum(2) < 1
+        new = self.get_remap_table().to(inds.device)[inds.long()]
+        unknown = new < 0
         if self.unknown_index == "random":
             new[unknown] = torch.randint(0, self.re_embed, size=new[unknown].shape).to(
                 device=new.device
@@ -74,7 +193,7 @@ class VectorQuantizer2(nn.Module):
         used = self.used.to(inds)
         if self.re_embed > self.used.shape[0]:  # extra token
             inds[inds >= self.used.shape[0]] = 0  # simply set to zero
-        back = torch.gather(used[None, :][inds.shape[0] * [0], :], 1, inds)
+        back = used[inds]
         return back.reshape(ishape)
 
     def forward(self, z, temp=None, rescale_logits=False, return_logits=False):
@@ -84,20 +203,10 @@ class VectorQuantizer2(nn.Module):
         # reshape z -> (batch, height, width, channel) and flatten
         # z = rearrange(z, 'b c h w -> b h w c').contiguous()
         z_flattened = z.view(-1, self.e_dim)
-        # distances from z to embeddings e_j (z - e)^2 = z^2 + e^2 - 2 e * z
-
-        d = (
-            torch.sum(z_flattened**2, dim=1, keepdim=True)
-            + torch.sum(self.embedding.weight**2, dim=1)
-            - 2
-            * torch.einsum(
-                "bd,dn->bn", z_flattened, rearrange(self.embedding.weight, "n d -> d n")
-            )
-        )
 
-        min_encoding_indices = torch.argmin(d, dim=1)
+        min_encoding_indices = self.find_nearest_codes(z_flattened)
         z_q = self.embedding(min_encoding_indices).view(z.shape)
-        perplexity = None
+        perplexity = self.get_perplexity(min_encoding_indices)
         min_encodings = None
 
         # compute loss for embedding
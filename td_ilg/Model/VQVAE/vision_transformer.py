@@ -19,6 +19,7 @@ class VisionTransformer(nn.Module):
         drop_path_rate=0.0,
         norm_layer=nn.LayerNorm,
         init_values=0.0,
+        use_sdpa=True,
     ):
         super().__init__()
         # num_features for consistency with other models
@@ -41,6 +42,7 @@ class VisionTransformer(nn.Module):
                     drop_path=dpr[i],
                     norm_layer=norm_layer,
                     init_values=init_values,
+                    use_sdpa=use_sdpa,
                 )
                 for i in range(depth)
             ]
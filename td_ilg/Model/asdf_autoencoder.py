@@ -28,22 +28,44 @@ class ASDFAutoEncoder(nn.Module):
         return
 
     def encodeASDF(
-        self, points: torch.Tensor, idxs: Union[np.ndarray, torch.Tensor, None] = None
+        self,
+        points: torch.Tensor,
+        idxs: Union[np.ndarray, torch.Tensor, None] = None,
+        knn_idxs: Union[torch.Tensor, None] = None,
     ) -> torch.Tensor:
-        return self.asdf_encoder(points, idxs)
+        return self.asdf_encoder(points, idxs, knn_idxs)
 
-    def decodeASDF(self, asdf_params: torch.Tensor) -> torch.Tensor:
+    def decodeShapeASDF(self, asdf_params: torch.Tensor) -> torch.Tensor:
+        # asdf_params: asdf_channel x D params of one shape, returns N x 3 points
         self.asdf_model.loadTorchParams(asdf_params)
         return self.asdf_model.forwardASDF(self.rad_density)
 
+    def decodeASDF(self, asdf_params: torch.Tensor) -> torch.Tensor:
+        """
+        asdf_params: asdf_channel x D params of one shape, or B x asdf_channel x D
+        returns the N x 3 surface points of the shape, or B x N x 3
+        ASDFModel holds the params of a single shape as module state, so a batch is
+        decoded shape by shape through it, every shape samples the same number of
+        points
+        """
+        if asdf_params.dim() == 2:
+            return self.decodeShapeASDF(asdf_params)
+
+        asdf_points_list = [
+            self.decodeShapeASDF(shape_params) for shape_params in asdf_params
+        ]
+        point_nums = set(asdf_points.shape[0] for asdf_points in asdf_points_list)
+        assert len(point_nums) == 1, "shapes decoded to different point numbers"
+        return torch.stack(asdf_points_list)
+
     def forward(
-        self, points: torch.Tensor, idxs: Union[np.ndarray, torch.Tensor, None] = None
+        self,
+        points: torch.Tensor,
+        idxs: Union[np.ndarray, torch.Tensor, None] = None,
+        knn_idxs: Union[torch.Tensor, None] = None,
     ) -> torch.Tensor:
-        # TODO: allow multi batch for ASDFModel later for faster training speed
-        assert points.shape[0] == 1
-
-        asdf_params = self.encodeASDF(points, idxs)
-        asdf_points = self.decodeASDF(asdf_params[0]).unsqueeze(0)
+        asdf_params = self.encodeASDF(points, idxs, knn_idxs)
+        asdf_points = self.decodeASDF(asdf_params)
         return asdf_points
 
     @torch.jit.ignore
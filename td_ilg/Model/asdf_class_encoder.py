@@ -3,11 +3,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from td_ilg.Model.gpt import GPT
-from td_ilg.Method.model import sample
+from td_ilg.Method.model import sample, createGenerators
 from td_ilg.Config.cfg import _cfg
+from td_ilg.Model.class_prefix_sampler import ClassPrefixSampler
 
 
-class ASDFClassEncoder(nn.Module):
+class ASDFClassEncoder(ClassPrefixSampler, nn.Module):
     """Container module with an encoder, a recurrent or transformer module, and a decoder."""
 
     def __init__(
@@ -19,6 +20,9 @@ class ASDFClassEncoder(nn.Module):
         nclasses=55,
         coord_vocab_size=256,
         reso=128,
+        attn_backend="vanilla",
+        attn_window=0,
+        attn_global=1,
     ):
         super(ASDFClassEncoder, self).__init__()
         self.reso = reso
@@ -49,6 +53,9 @@ class ASDFClassEncoder(nn.Module):
             embd_pdrop=0.1,
             resid_pdrop=0.1,
             attn_pdrop=0.1,
+            attn_backend=attn_backend,
+            attn_window=attn_window,
+            attn_global=attn_global,
         )
 
         self.ln_x = nn.LayerNorm(ninp)
@@ -72,6 +79,22 @@ class ASDFClassEncoder(nn.Module):
         self.ln_latent = nn.LayerNorm(ninp)
         self.latent_head = nn.Linear(ninp, asdf_dim - 6, bias=False)
 
+        # transformer blocks used to predict x, y, z, tx, ty, tz and latent
+        self.stage_blocks = [
+            (0, 12),
+            (12, 16),
+            (16, 20),
+            (20, 24),
+            (24, 28),
+            (28, 32),
+            (32, 36),
+        ]
+
+        # class id -> stage 0 keys, values and output of the condition token
+        self.prefix_cache = None
+        # accepted / drafted anchors of the last sample_speculative call
+        self.speculative_acceptance_rate = None
+
         self.default_cfg = _cfg()
         return
 
@@ -208,8 +231,360 @@ class ASDFClassEncoder(nn.Module):
             latent_logits,
         )
 
+    def get_coord_stages(self):
+        return [
+            (self.ln_x, self.x_head, self.x_tok_emb),
+            (self.ln_y, self.y_head, self.y_tok_emb),
+            (self.ln_z, self.z_head, self.z_tok_emb),
+            (self.ln_tx, self.tx_head, self.tx_tok_emb),
+            (self.ln_ty, self.ty_head, self.ty_tok_emb),
+            (self.ln_tz, self.tz_head, self.tz_tok_emb),
+        ]
+
+    def forward_stage_with_past(
+        self, stage_idx, x, coord_token_embeddings, position, past, stage_blocks=None
+    ):
+        # x: B x T x C, dropped input embeddings for stage 0, previous stage output otherwise
+        # coord_token_embeddings: B x T x C, sum of the coord embeddings sampled so far
+        if stage_idx > 0:
+            T = x.shape[1]
+            x = x + coord_token_embeddings + self.pos_emb[:, position : position + T, :]
+            if stage_idx > 2:
+                x = x + self.tpos_emb[:, position : position + T, :]
+
+        if stage_blocks is None:
+            stage_blocks = self.stage_blocks
+        start, end = stage_blocks[stage_idx]
+        return self.forward_blocks_with_past(x, start, end, past)
+
+    @torch.no_grad()
+    def sample_anchor(
+        self,
+        token_embeddings,
+        position,
+        past,
+        prefix_x=None,
+        stage_blocks=None,
+        prefix_coords=None,
+        **sample_kwargs,
+    ):
+        # token_embeddings: B x 1 x C, embedding of the previous anchor (or the class condition)
+        # prefix_x: B x 1 x C, stage 0 output already written to past by load_class_prefix,
+        # or the output of stage len(prefix_coords) with prefix_coords
+        # stage_blocks: blocks run by each stage, self.stage_blocks by default
+        x, coords, coord_token_embeddings = self.sample_coords(
+            token_embeddings,
+            position,
+            past,
+            prefix_x,
+            stage_blocks,
+            prefix_coords,
+            **sample_kwargs,
+        )
+
+        x = self.forward_stage_with_past(
+            len(self.stage_blocks) - 1,
+            x,
+            coord_token_embeddings,
+            position,
+            past,
+            stage_blocks,
+        )
+        latent = self.latent_head(self.ln_latent(x))  # B x 1 x (asdf_dim - 6)
+
+        next_token_embeddings = self.latent_encoder(latent) + coord_token_embeddings
+        coords = torch.cat([coord.unsqueeze(-1) for coord in coords], dim=-1)
+        return coords, latent, next_token_embeddings
+
+    @torch.no_grad()
+    def sample_stage(
+        self, stage_idx, x, coord_token_embeddings, position, past, **sample_kwargs
+    ):
+        """
+        run a single stage of sample_anchor, e.g. in a stage pipeline
+        x: B x 1 x C, token embeddings of the anchor for stage 0, previous stage output otherwise
+        returns the stage output, the sampled coord B x 1 and the updated coord embeddings,
+        the last stage returns the latent, None and the next token embeddings instead
+        """
+        if stage_idx == 0:
+            x = self.transformer.drop(x + self.pos_emb[:, position : position + 1, :])
+        x = self.forward_stage_with_past(
+            stage_idx, x, coord_token_embeddings, position, past
+        )
+
+        if stage_idx == len(self.stage_blocks) - 1:
+            latent = self.latent_head(self.ln_latent(x))
+            next_token_embeddings = self.latent_encoder(latent) + coord_token_embeddings
+            return latent, None, next_token_embeddings
+
+        ln, head, tok_emb = self.get_coord_stages()[stage_idx]
+        coord = sample(head(ln(x)), **sample_kwargs)
+        if coord_token_embeddings is None:
+            coord_token_embeddings = tok_emb(coord)
+        else:
+            coord_token_embeddings = coord_token_embeddings + tok_emb(coord)
+        return x, coord, coord_token_embeddings
+
+    @torch.no_grad()
+    def forward_anchors_with_past(
+        self, token_embeddings, coords, position, past, stage_blocks=None
+    ):
+        """
+        teacher-forced pass over T anchors whose coords are already known
+        token_embeddings: B x T x C, input token of each anchor
+        coords: B x T x 6
+        returns the greedy coords predicted by every stage B x T x 6, the latents
+        B x T x (asdf_dim - 6), the input token following each anchor B x T x C and
+        the list of the coord stage outputs, each B x T x C
+        """
+        T = token_embeddings.shape[1]
+        x = self.transformer.drop(
+            token_embeddings + self.pos_emb[:, position : position + T, :]
+        )
+        x = self.forward_stage_with_past(0, x, None, position, past, stage_blocks)
+
+        stage_xs = []
+        predicted_coords = []
+        coord_token_embeddings = None
+        for stage_idx, (ln, head, tok_emb) in enumerate(self.get_coord_stages()):
+            if stage_idx > 0:
+                x = self.forward_stage_with_past(
+                    stage_idx, x, coord_token_embeddings, position, past, stage_blocks
+                )
+            stage_xs.append(x)
+            predicted_coords.append(torch.argmax(head(ln(x)), dim=-1))
+            if coord_token_embeddings is None:
+                coord_token_embeddings = tok_emb(coords[:, :, stage_idx])
+            else:
+                coord_token_embeddings = coord_token_embeddings + tok_emb(
+                    coords[:, :, stage_idx]
+                )
+
+        x = self.forward_stage_with_past(
+            len(self.stage_blocks) - 1,
+            x,
+            coord_token_embeddings,
+            position,
+            past,
+            stage_blocks,
+        )
+        latent = self.latent_head(self.ln_latent(x))
+
+        next_token_embeddings = self.latent_encoder(latent) + coord_token_embeddings
+        return (
+            torch.stack(predicted_coords, dim=-1),
+            latent,
+            next_token_embeddings,
+            stage_xs,
+        )
+
+    @torch.no_grad()
+    def sample_speculative(
+        self,
+        cond,
+        draft_blocks=(4, 1, 1, 1, 1, 1, 1),
+        gamma=4,
+        latent_tolerance=0.0,
+        **sample_kwargs,
+    ):
+        """
+        greedy speculative decoding. the first draft_blocks[i] blocks of every stage
+        form the draft model, which proposes gamma anchors ahead, and the full model
+        verifies all of them in one teacher-forced pass.
+        drafted coords are accepted while they match the full model, at the first
+        mismatch the full model coord is taken and its anchor is finished by the full
+        model, reusing the verified keys and values. the returned latents are those
+        of the full model.
+        the input of a drafted anchor is built from the draft latent of its
+        predecessor, so it is only accepted while that latent is within
+        latent_tolerance of the full model latent. the default 0 reproduces
+        sample(cond), which for continuous latents accepts one anchor per pass.
+        a positive latent_tolerance opts into approximate decoding, the full model
+        then also attends to the accepted draft latents
+        only greedy decoding is supported, a positive temperature raises
+        """
+        temperature = sample_kwargs.get("temperature", 0.0)
+        if (torch.as_tensor(temperature) > 0).any():
+            raise ValueError(
+                "sample_speculative only decodes greedily, temperature > 0"
+            )
+
+        draft_stage_blocks = [
+            (start, start + depth)
+            for (start, _), depth in zip(self.stage_blocks, draft_blocks)
+        ]
+        coord_stage_num = len(self.stage_blocks) - 1
+
+        past = self.transformer.create_kv_cache(cond.shape[0])
+        draft_past = self.transformer.create_kv_cache(cond.shape[0])
+        token_embeddings = cond[:, None]
+
+        coords_list = []
+        latent_list = []
+        drafted_num = 0
+        accepted_num = 0
+        position = 0
+        while position < self.reso:
+            draft_num = min(gamma, self.reso - position)
+
+            draft_token_embeddings = [token_embeddings]
+            draft_coords = []
+            draft_latents = []
+            for i in range(draft_num):
+                coords, latent, next_token_embeddings = self.sample_anchor(
+                    draft_token_embeddings[-1],
+                    position + i,
+                    draft_past,
+                    stage_blocks=draft_stage_blocks,
+                )
+                draft_coords.append(coords)
+                draft_latents.append(latent)
+                draft_token_embeddings.append(next_token_embeddings)
+            draft_token_embeddings = torch.cat(draft_token_embeddings[:-1], dim=1)
+            draft_coords = torch.cat(draft_coords, dim=1)  # B x G x 6
+            draft_latents = torch.cat(draft_latents, dim=1)
+
+            (
+                full_coords,
+                full_latents,
+                full_token_embeddings,
+                stage_xs,
+            ) = self.forward_anchors_with_past(
+                draft_token_embeddings, draft_coords, position, past
+            )
+
+            # accepted[:, i, s]: coord s of anchor i, then the latent of anchor i as
+            # the input of anchor i + 1, in decoding order
+            latent_error = (draft_latents - full_latents).abs().amax(dim=-1)
+            latent_error[:, -1] = 0
+            accepted = torch.cat(
+                [
+                    full_coords == draft_coords,
+                    (latent_error <= latent_tolerance)[:, :, None],
+                ],
+                dim=-1,
+            ).flatten(1)
+            # the first rejection of the batch is used for every row
+            accepted_token_num = int(accepted.long().cumprod(dim=1).sum(dim=1).min())
+            anchor_idx, stage_idx = divmod(accepted_token_num, coord_stage_num + 1)
+            # with stage_idx == coord_stage_num the coords of anchor_idx are accepted
+            # but not its draft latent as the input of the next anchor
+            accepted_anchor_num = anchor_idx + int(stage_idx == coord_stage_num)
+
+            drafted_num += draft_num
+            accepted_num += accepted_anchor_num
+
+            if accepted_anchor_num > 0:
+                coords_list.append(draft_coords[:, :accepted_anchor_num])
+                latent_list.append(full_latents[:, :accepted_anchor_num])
+                token_embeddings = full_token_embeddings[
+                    :, accepted_anchor_num - 1 : accepted_anchor_num
+                ]
+
+            if stage_idx == coord_stage_num or anchor_idx == draft_num:
+                past.truncate(position + accepted_anchor_num)
+                draft_past.truncate(position + accepted_anchor_num)
+                position += accepted_anchor_num
+                continue
+
+            # coord stage_idx of the anchor is rejected, its input and the coords
+            # before are verified, so the keys and values of the stages up to
+            # stage_idx are kept and the anchor is finished with the full model coord
+            anchor_position = position + anchor_idx
+            _, end = self.stage_blocks[stage_idx]
+            past.truncate(anchor_position + 1, None, end)
+            past.truncate(anchor_position, end)
+            draft_past.truncate(anchor_position)
+            coords, latent, next_token_embeddings = self.sample_anchor(
+                draft_token_embeddings[:, anchor_idx : anchor_idx + 1],
+                anchor_position,
+                past,
+                prefix_x=stage_xs[stage_idx][:, anchor_idx : anchor_idx + 1],
+                prefix_coords=[
+                    draft_coords[:, anchor_idx : anchor_idx + 1, i]
+                    for i in range(stage_idx)
+                ],
+            )
+            self.forward_anchors_with_past(
+                draft_token_embeddings[:, anchor_idx : anchor_idx + 1],
+                coords,
+                anchor_position,
+                draft_past,
+                draft_stage_blocks,
+            )
+            coords_list.append(coords)
+            latent_list.append(latent)
+            token_embeddings = next_token_embeddings
+            position = anchor_position + 1
+
+        self.speculative_acceptance_rate = accepted_num / drafted_num
+
+        coords = torch.cat(coords_list, dim=1)  # B x S x 6
+        latent = torch.cat(latent_list, dim=1)  # B x S x (asdf_dim - 6)
+
+        return torch.cat(
+            [
+                coords / 128.0 - 1.0,
+                latent,
+            ],
+            dim=-1,
+        )
+
+    @torch.no_grad()
+    def sample(
+        self, cond, use_cache=True, seeds=None, categories=None, **sample_kwargs
+    ):
+        # cond: B x C, one shape per row, seeds: optional list of B per-shape seeds
+        # categories: class ids of cond, required to use the prefix cache
+        sample_kwargs["generators"] = createGenerators(seeds, cond.device)
+
+        if not use_cache:
+            return self.sample_without_cache(cond, **sample_kwargs)
+
+        token_embeddings = cond[:, None]
+        past = self.transformer.create_kv_cache(cond.shape[0])
+
+        prefix_x = None
+        if categories is not None and self.prefix_cache is not None:
+            prefix_x = self.load_class_prefix(categories, past)
+
+        coords_list = []
+        latent_list = []
+        for i in range(self.reso):
+            coords, latent, token_embeddings = self.sample_anchor(
+                token_embeddings,
+                i,
+                past,
+                prefix_x=prefix_x if i == 0 else None,
+                **sample_kwargs,
+            )
+            coords_list.append(coords)
+            latent_list.append(latent)
+
+        coords = torch.cat(coords_list, dim=1)  # B x S x 6
+        latent = torch.cat(latent_list, dim=1)  # B x S x (asdf_dim - 6)
+
+        return torch.cat(
+            [
+                coords / 128.0 - 1.0,
+                latent,
+            ],
+            dim=-1,
+        )
+
+    @torch.no_grad()
+    def sample_classes(self, categories, seeds=None, **sample_kwargs):
+        # categories: B class ids, one generated shape per id
+        return self.sample(
+            self.class_enc(categories),
+            seeds=seeds,
+            categories=categories,
+            **sample_kwargs,
+        )
+
     @torch.no_grad()
-    def sample(self, cond):
+    def sample_without_cache(self, cond, **sample_kwargs):
+        # reference loop re-running the whole prefix for every anchor
         cond = cond[:, None]
 
         position_embeddings = self.pos_emb
@@ -230,7 +605,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[:12]:
                     x = block(x)  # B x S x C
                 coord1_logits = self.x_head(self.ln_x(x))
-                ix = sample(coord1_logits)
+                ix = sample(coord1_logits, **sample_kwargs)
                 coord1 = ix
                 x_token_embeddings = self.x_tok_emb(coord1)
 
@@ -238,7 +613,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[12:16]:
                     x = block(x)  # B x S x C
                 coord2_logits = self.y_head(self.ln_y(x))
-                ix = sample(coord2_logits)
+                ix = sample(coord2_logits, **sample_kwargs)
                 coord2 = ix
                 y_token_embeddings = self.y_tok_emb(coord2)
 
@@ -251,7 +626,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[16:20]:
                     x = block(x)  # B x S x C
                 coord3_logits = self.z_head(self.ln_z(x))
-                ix = sample(coord3_logits)
+                ix = sample(coord3_logits, **sample_kwargs)
                 coord3 = ix
                 z_token_embeddings = self.z_tok_emb(coord3)
 
@@ -266,7 +641,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[20:24]:
                     x = block(x)  # B x S x C
                 coordt1_logits = self.tx_head(self.ln_tx(x))
-                ix = sample(coordt1_logits)
+                ix = sample(coordt1_logits, **sample_kwargs)
                 coordt1 = ix
                 tx_token_embeddings = self.tx_tok_emb(coordt1)
 
@@ -282,7 +657,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[24:28]:
                     x = block(x)  # B x S x C
                 coordt2_logits = self.ty_head(self.ln_ty(x))
-                ix = sample(coordt2_logits)
+                ix = sample(coordt2_logits, **sample_kwargs)
                 coordt2 = ix
                 ty_token_embeddings = self.ty_tok_emb(coordt2)
 
@@ -299,7 +674,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[28:32]:
                     x = block(x)  # B x S x C
                 coordt3_logits = self.tz_head(self.ln_tz(x))
-                ix = sample(coordt3_logits)
+                ix = sample(coordt3_logits, **sample_kwargs)
                 coordt3 = ix
                 tz_token_embeddings = self.tz_tok_emb(coordt3)
 
@@ -323,9 +698,9 @@ class ASDFClassEncoder(nn.Module):
                 x_token_embeddings = self.x_tok_emb(coord1)  # B x S x C
                 y_token_embeddings = self.y_tok_emb(coord2)  # B x S x C
                 z_token_embeddings = self.z_tok_emb(coord3)  # B x S x C
-                tx_token_embeddings = self.x_tok_emb(coordt1)  # B x S x C
-                ty_token_embeddings = self.y_tok_emb(coordt2)  # B x S x C
-                tz_token_embeddings = self.z_tok_emb(coordt3)  # B x S x C
+                tx_token_embeddings = self.tx_tok_emb(coordt1)  # B x S x C
+                ty_token_embeddings = self.ty_tok_emb(coordt2)  # B x S x C
+                tz_token_embeddings = self.tz_tok_emb(coordt3)  # B x S x C
                 latent_features = self.latent_encoder(latent)
 
                 token_embeddings = torch.cat(
@@ -351,7 +726,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[:12]:
                     x = block(x)  # B x S x C
                 coord1_logits = self.x_head(self.ln_x(x))
-                ix = sample(coord1_logits)
+                ix = sample(coord1_logits, **sample_kwargs)
                 coord1 = torch.cat((coord1, ix), dim=1)
                 x_token_embeddings = self.x_tok_emb(coord1)
 
@@ -359,7 +734,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[12:16]:
                     x = block(x)  # B x S x C
                 coord2_logits = self.y_head(self.ln_y(x))
-                ix = sample(coord2_logits)
+                ix = sample(coord2_logits, **sample_kwargs)
                 coord2 = torch.cat((coord2, ix), dim=1)
                 y_token_embeddings = self.y_tok_emb(coord2)
 
@@ -372,7 +747,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[16:20]:
                     x = block(x)  # B x S x C
                 coord3_logits = self.z_head(self.ln_z(x))
-                ix = sample(coord3_logits)
+                ix = sample(coord3_logits, **sample_kwargs)
                 coord3 = torch.cat((coord3, ix), dim=1)
                 z_token_embeddings = self.z_tok_emb(coord3)
 
@@ -387,7 +762,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[20:24]:
                     x = block(x)  # B x S x C
                 coordt1_logits = self.tx_head(self.ln_tx(x))
-                ix = sample(coordt1_logits)
+                ix = sample(coordt1_logits, **sample_kwargs)
                 coordt1 = torch.cat((coordt1, ix), dim=1)
                 tx_token_embeddings = self.tx_tok_emb(coordt1)
 
@@ -403,7 +778,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[24:28]:
                     x = block(x)  # B x S x C
                 coordt2_logits = self.ty_head(self.ln_ty(x))
-                ix = sample(coordt2_logits)
+                ix = sample(coordt2_logits, **sample_kwargs)
                 coordt2 = torch.cat((coordt2, ix), dim=1)
                 ty_token_embeddings = self.ty_tok_emb(coordt2)
 
@@ -420,7 +795,7 @@ class ASDFClassEncoder(nn.Module):
                 for block in self.transformer.blocks[28:32]:
                     x = block(x)  # B x S x C
                 coordt3_logits = self.tz_head(self.ln_tz(x))
-                ix = sample(coordt3_logits)
+                ix = sample(coordt3_logits, **sample_kwargs)
                 coordt3 = torch.cat((coordt3, ix), dim=1)
                 tz_token_embeddings = self.tz_tok_emb(coordt3)
 
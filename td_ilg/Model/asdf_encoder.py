@@ -1,7 +1,6 @@
 import torch
 import numpy as np
 import torch.nn as nn
-from math import ceil
 from typing import Union
 from functools import partial
 from torch.nn import ReLU
@@ -9,15 +8,26 @@ from torch.nn import Linear as Lin
 from torch.nn import Sequential as Seq
 from torch.nn.utils.parametrizations import weight_norm
 
-from torch_cluster import fps, knn
+try:
+    from torch_cluster import fps, knn
+except ImportError:
+    from td_ilg.Method.cluster import fps, knn
 
 from td_ilg.Method.embed import embed
+from td_ilg.Method.neighbour import toEdgeIndex, toNeighbourNum
 from td_ilg.Model.VQVAE.vision_transformer import VisionTransformer
 from td_ilg.Model.VQVAE.point_conv import PointConv
 
 
 class ASDFEncoder(nn.Module):
-    def __init__(self, asdf_channel=40, sh_2d_degree=3, sh_3d_degree=6, hidden_dim=128):
+    def __init__(
+        self,
+        asdf_channel=40,
+        sh_2d_degree=3,
+        sh_3d_degree=6,
+        hidden_dim=128,
+        edge_chunk_size=0,
+    ):
         super().__init__()
         self.embedding_dim = 48
 
@@ -72,6 +82,7 @@ class ASDFEncoder(nn.Module):
                 ReLU(True),
                 weight_norm(Lin(hidden_dim, hidden_dim)),
             ),
+            edge_chunk_size=edge_chunk_size,
         )
 
         self.xyz_transformer = VisionTransformer(
@@ -168,7 +179,15 @@ class ASDFEncoder(nn.Module):
 
         return
 
-    def forward(self, pc, idx: Union[np.ndarray, torch.Tensor, None] = None):
+    def forward(
+        self,
+        pc,
+        idx: Union[np.ndarray, torch.Tensor, None] = None,
+        knn_idx: Union[torch.Tensor, None] = None,
+    ):
+        # idx: B x asdf_channel sample indices into each point cloud
+        # knn_idx: B x asdf_channel x k neighbour indices of the samples, e.g. from
+        # a NeighbourCacher cache, skips fps and knn
         B, N, D = pc.shape
 
         pos = pc.view(B * N, D)
@@ -176,16 +195,27 @@ class ASDFEncoder(nn.Module):
         batch = torch.arange(B).to(pc.device)
         batch = torch.repeat_interleave(batch, N)
 
-        if idx is None:
-            idx = fps(pos, batch, ratio=self.asdf_channel / N)
+        k = toNeighbourNum(N, self.asdf_channel)
+
+        if knn_idx is not None:
+            assert idx is not None and idx.shape[1] == self.asdf_channel
+            assert knn_idx.shape[-1] == k, "the cached graph was built with another k"
+            idx, edge_index = toEdgeIndex(
+                torch.as_tensor(idx, device=pc.device), knn_idx, N
+            )
         else:
-            assert idx.shape[1] == self.asdf_channel
-            idx = torch.cat([idx[i] + i * N for i in range(idx.shape[0])])
+            if idx is None:
+                idx = fps(pos, batch, ratio=self.asdf_channel / N)
+            else:
+                assert idx.shape[1] == self.asdf_channel
+                idx = torch.cat([idx[i] + i * N for i in range(idx.shape[0])])
 
-        row, col = knn(pos, pos[idx], ceil(N / self.asdf_channel), batch, batch[idx])
-        edge_index = torch.stack([col, row], dim=0)
+            row, col = knn(pos, pos[idx], k, batch, batch[idx])
+            edge_index = torch.stack([col, row], dim=0)
 
-        points_feature = self.conv(pos, pos[idx], edge_index, self.basis)
+        points_feature = self.conv(
+            pos, pos[idx], edge_index, self.basis, dim_size=idx.shape[0]
+        )
         center = pos[idx]
 
         points_feature = points_feature.view(B, -1, points_feature.shape[-1])
@@ -3,11 +3,12 @@ import torch.nn as nn
 import torch.nn.functional as F
 
 from td_ilg.Model.gpt import GPT
-from td_ilg.Method.model import sample
+from td_ilg.Method.model import sample, createGenerators
 from td_ilg.Config.cfg import _cfg
+from td_ilg.Model.class_prefix_sampler import ClassPrefixSampler
 
 
-class ClassEncoder(nn.Module):
+class ClassEncoder(ClassPrefixSampler, nn.Module):
     """Container module with an encoder, a recurrent or transformer module, and a decoder."""
 
     def __init__(
@@ -19,6 +20,9 @@ class ClassEncoder(nn.Module):
         coord_vocab_size=256,
         latent_vocab_size=512,
         reso=128,
+        attn_backend="vanilla",
+        attn_window=0,
+        attn_global=1,
     ):
         super(ClassEncoder, self).__init__()
         self.reso = reso
@@ -46,6 +50,9 @@ class ClassEncoder(nn.Module):
             embd_pdrop=0.1,
             resid_pdrop=0.1,
             attn_pdrop=0.1,
+            attn_backend=attn_backend,
+            attn_window=attn_window,
+            attn_global=attn_global,
         )
 
         self.ln_x = nn.LayerNorm(ninp)
@@ -60,6 +67,12 @@ class ClassEncoder(nn.Module):
         self.ln_latent = nn.LayerNorm(ninp)
         self.latent_head = nn.Linear(ninp, latent_vocab_size, bias=False)
 
+        # transformer blocks used to predict x, y, z and latent
+        self.stage_blocks = [(0, 12), (12, 16), (16, 20), (20, nlayers)]
+
+        # class id -> stage 0 keys, values and output of the condition token
+        self.prefix_cache = None
+
         self.default_cfg = _cfg()
         return
 
@@ -130,8 +143,95 @@ class ClassEncoder(nn.Module):
 
         return x_logits, y_logits, z_logits, latent_logits
 
+    def get_coord_stages(self):
+        return [
+            (self.ln_x, self.x_head, self.x_tok_emb),
+            (self.ln_y, self.y_head, self.y_tok_emb),
+            (self.ln_z, self.z_head, self.z_tok_emb),
+        ]
+
+    def forward_stage_with_past(
+        self, stage_idx, x, coord_token_embeddings, position, past, stage_blocks=None
+    ):
+        # x: B x T x C, dropped input embeddings for stage 0, previous stage output otherwise
+        # coord_token_embeddings: B x T x C, sum of the coord embeddings sampled so far
+        if stage_idx > 0:
+            T = x.shape[1]
+            x = x + coord_token_embeddings + self.pos_emb[:, position : position + T, :]
+
+        if stage_blocks is None:
+            stage_blocks = self.stage_blocks
+        start, end = stage_blocks[stage_idx]
+        return self.forward_blocks_with_past(x, start, end, past)
+
+    @torch.no_grad()
+    def sample_anchor(
+        self, token_embeddings, position, past, prefix_x=None, **sample_kwargs
+    ):
+        # token_embeddings: B x 1 x C, embedding of the previous anchor (or the class condition)
+        # prefix_x: B x 1 x C, stage 0 output already written to past by load_class_prefix
+        x, coords, coord_token_embeddings = self.sample_coords(
+            token_embeddings, position, past, prefix_x, **sample_kwargs
+        )
+
+        x = self.forward_stage_with_past(
+            len(self.stage_blocks) - 1, x, coord_token_embeddings, position, past
+        )
+        latent = sample(self.latent_head(self.ln_latent(x)), **sample_kwargs)  # B x 1
+
+        next_token_embeddings = self.latent_tok_emb(latent) + coord_token_embeddings
+        return coords, latent, next_token_embeddings
+
+    @torch.no_grad()
+    def sample(
+        self, cond, use_cache=True, seeds=None, categories=None, **sample_kwargs
+    ):
+        # cond: B x C, one shape per row, seeds: optional list of B per-shape seeds
+        # categories: class ids of cond, required to use the prefix cache
+        sample_kwargs["generators"] = createGenerators(seeds, cond.device)
+
+        if not use_cache:
+            return self.sample_without_cache(cond, **sample_kwargs)
+
+        token_embeddings = cond[:, None]
+        past = self.transformer.create_kv_cache(cond.shape[0])
+
+        prefix_x = None
+        if categories is not None and self.prefix_cache is not None:
+            prefix_x = self.load_class_prefix(categories, past)
+
+        coords_list = []
+        latent_list = []
+        for i in range(self.reso):
+            coords, latent, token_embeddings = self.sample_anchor(
+                token_embeddings,
+                i,
+                past,
+                prefix_x=prefix_x if i == 0 else None,
+                **sample_kwargs,
+            )
+            coords_list.append(coords)
+            latent_list.append(latent)
+
+        coord1, coord2, coord3 = [
+            torch.cat([coords[j] for coords in coords_list], dim=1) for j in range(3)
+        ]
+        latent = torch.cat(latent_list, dim=1)
+        return coord1, coord2, coord3, latent
+
+    @torch.no_grad()
+    def sample_classes(self, categories, seeds=None, **sample_kwargs):
+        # categories: B class ids, one generated shape per id
+        return self.sample(
+            self.class_enc(categories),
+            seeds=seeds,
+            categories=categories,
+            **sample_kwargs,
+        )
+
     @torch.no_grad()
-    def sample(self, cond):
+    def sample_without_cache(self, cond, **sample_kwargs):
+        # reference loop re-running the whole prefix for every anchor
         cond = cond[:, None]
 
         position_embeddings = self.pos_emb
@@ -152,7 +252,7 @@ class ClassEncoder(nn.Module):
                 print("sample x2:", x.shape)
                 coord1_logits = self.x_head(self.ln_x(x))
                 print("sample coord1_logits:", coord1_logits.shape)
-                ix = sample(coord1_logits)
+                ix = sample(coord1_logits, **sample_kwargs)
                 print("sample ix:", ix.shape)
                 print("ix:", ix)
                 coord1 = ix
@@ -168,7 +268,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[12:16]:
                     x = block(x)  # B x S x C
                 coord2_logits = self.y_head(self.ln_y(x))
-                ix = sample(coord2_logits)
+                ix = sample(coord2_logits, **sample_kwargs)
                 coord2 = ix
                 y_token_embeddings = self.y_tok_emb(coord2)
 
@@ -181,7 +281,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[16:20]:
                     x = block(x)  # B x S x C
                 coord3_logits = self.z_head(self.ln_z(x))
-                ix = sample(coord3_logits)
+                ix = sample(coord3_logits, **sample_kwargs)
                 coord3 = ix
                 z_token_embeddings = self.z_tok_emb(coord3)
 
@@ -195,7 +295,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[20:]:
                     x = block(x)  # B x S x C
                 latent_logits = self.latent_head(self.ln_latent(x))
-                ix = sample(latent_logits)
+                ix = sample(latent_logits, **sample_kwargs)
                 latent = ix
                 print("sample latent_logits:", latent_logits.shape, latent_logits.dtype)
 
@@ -225,7 +325,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[:12]:
                     x = block(x)  # B x S x C
                 coord1_logits = self.x_head(self.ln_x(x))
-                ix = sample(coord1_logits)
+                ix = sample(coord1_logits, **sample_kwargs)
                 coord1 = torch.cat((coord1, ix), dim=1)
                 x_token_embeddings = self.x_tok_emb(coord1)
 
@@ -233,7 +333,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[12:16]:
                     x = block(x)  # B x S x C
                 coord2_logits = self.y_head(self.ln_y(x))
-                ix = sample(coord2_logits)
+                ix = sample(coord2_logits, **sample_kwargs)
                 coord2 = torch.cat((coord2, ix), dim=1)
                 y_token_embeddings = self.y_tok_emb(coord2)
 
@@ -246,7 +346,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[16:20]:
                     x = block(x)  # B x S x C
                 coord3_logits = self.z_head(self.ln_z(x))
-                ix = sample(coord3_logits)
+                ix = sample(coord3_logits, **sample_kwargs)
                 coord3 = torch.cat((coord3, ix), dim=1)
                 z_token_embeddings = self.z_tok_emb(coord3)
 
@@ -260,7 +360,7 @@ class ClassEncoder(nn.Module):
                 for block in self.transformer.blocks[20:]:
                     x = block(x)  # B x S x C
                 latent_logits = self.latent_head(self.ln_latent(x))
-                ix = sample(latent_logits)
+                ix = sample(latent_logits, **sample_kwargs)
                 latent = torch.cat((latent, ix), dim=1)
         return coord1, coord2, coord3, latent
 
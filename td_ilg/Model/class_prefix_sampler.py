@@ -0,0 +1,121 @@
+import torch
+
+from td_ilg.Data.lru_cache import LRUCache
+from td_ilg.Method.model import sample, getModelVersion
+
+
+class ClassPrefixSampler(object):
+    """
+    KV cached anchor sampling shared by ClassEncoder and ASDFClassEncoder.
+    The encoder provides transformer, class_enc, pos_emb, stage_blocks,
+    prefix_cache, get_coord_stages and forward_stage_with_past.
+    """
+
+    def enable_prefix_cache(self, max_size=64):
+        self.prefix_cache = LRUCache(max_size)
+        return True
+
+    def get_model_version(self):
+        return getModelVersion(self, self.class_enc.weight)
+
+    def forward_blocks_with_past(self, x, start, end, past):
+        # past: KVCache of the transformer, updated in place
+        x, _ = self.transformer.forward_with_past(x, past, start, end)
+        return x
+
+    @torch.no_grad()
+    def load_class_prefix(self, categories, past):
+        """
+        write the stage 0 keys and values of the class condition token into past,
+        computing them only for classes missing from the prefix cache.
+        later stages of the first anchor already depend on its sampled coords,
+        so stage 0 is the part shared by every request of a class
+        returns the stage 0 output of the condition token, B x 1 x C
+        """
+        version = self.get_model_version()
+        start, end = self.stage_blocks[0]
+
+        entries = {}
+        missing = []
+        for category in set(categories.tolist()):
+            entry = self.prefix_cache.get((category, version))
+            if entry is None:
+                missing.append(category)
+            else:
+                entries[category] = entry
+
+        if len(missing) > 0:
+            missing_categories = torch.tensor(missing, device=categories.device)
+            prefix_past = self.transformer.create_kv_cache(len(missing))
+            x = self.transformer.drop(
+                self.class_enc(missing_categories)[:, None] + self.pos_emb[:, :1, :]
+            )
+            x = self.forward_stage_with_past(0, x, None, 0, prefix_past)
+            kv = prefix_past.kv[start:end, :, :, :, :1]  # L x 2 x M x nh x 1 x hs
+            for i, category in enumerate(missing):
+                entry = (kv[:, :, i].clone(), x[i].clone())
+                self.prefix_cache.put((category, version), entry)
+                entries[category] = entry
+
+        kv = torch.stack(
+            [entries[category][0] for category in categories.tolist()], dim=2
+        )  # L x 2 x B x nh x 1 x hs
+        for i in range(start, end):
+            past.update(i, kv[i - start, 0], kv[i - start, 1])
+
+        return torch.stack([entries[category][1] for category in categories.tolist()])
+
+    @torch.no_grad()
+    def sample_coords(
+        self,
+        token_embeddings,
+        position,
+        past,
+        prefix_x=None,
+        stage_blocks=None,
+        prefix_coords=None,
+        **sample_kwargs,
+    ):
+        """
+        run stage 0 and the coord stages of one anchor, sampling a coord per stage
+        token_embeddings: B x 1 x C, embedding of the previous anchor (or the class condition)
+        prefix_x: B x 1 x C, output of stage len(prefix_coords) already written to past,
+            e.g. the stage 0 output of load_class_prefix
+        stage_blocks: blocks run by each stage, self.stage_blocks by default
+        prefix_coords: list of the B x 1 coords of the first stages, already fixed
+        returns the output of the last coord stage, the list of sampled coords,
+        each B x 1, and the sum of their embeddings, B x 1 x C
+        """
+        coords = [] if prefix_coords is None else list(prefix_coords)
+        first_stage = len(coords)
+
+        if prefix_x is None:
+            assert first_stage == 0, "prefix_coords need the prefix_x of their stage"
+            x = self.transformer.drop(
+                token_embeddings + self.pos_emb[:, position : position + 1, :]
+            )
+            x = self.forward_stage_with_past(0, x, None, position, past, stage_blocks)
+        else:
+            x = prefix_x
+
+        coord_token_embeddings = None
+        for stage_idx, (ln, head, tok_emb) in enumerate(self.get_coord_stages()):
+            if stage_idx < first_stage:
+                coord = coords[stage_idx]
+            else:
+                if stage_idx > first_stage:
+                    x = self.forward_stage_with_past(
+                        stage_idx,
+                        x,
+                        coord_token_embeddings,
+                        position,
+                        past,
+                        stage_blocks,
+                    )
+                coord = sample(head(ln(x)), **sample_kwargs)  # B x 1
+                coords.append(coord)
+            if coord_token_embeddings is None:
+                coord_token_embeddings = tok_emb(coord)
+            else:
+                coord_token_embeddings = coord_token_embeddings + tok_emb(coord)
+        return x, coords, coord_token_embeddings
@@ -2,10 +2,10 @@ import logging
 
 import torch
 import torch.nn as nn
-from torch.nn import functional as F
 
 from td_ilg.Config.gpt import GPTConfig
 from td_ilg.Model.GPT.block import Block
+from td_ilg.Model.GPT.kv_cache import KVCache
 
 logger = logging.getLogger(__name__)
 
@@ -24,6 +24,9 @@ class GPT(nn.Module):
         resid_pdrop=0.0,
         attn_pdrop=0.0,
         n_unmasked=0,
+        attn_backend="vanilla",
+        attn_window=0,
+        attn_global=0,
     ):
         super().__init__()
         config = GPTConfig(
@@ -36,6 +39,9 @@ class GPT(nn.Module):
             n_head=n_head,
             n_embd=n_embd,
             n_unmasked=n_unmasked,
+            attn_backend=attn_backend,
+            attn_window=attn_window,
+            attn_global=attn_global,
         )
 
         self.drop = nn.Dropout(config.embd_pdrop)
@@ -72,51 +78,59 @@ class GPT(nn.Module):
 
         return x
 
-    def forward_with_past(
-        self, idx, embeddings=None, targets=None, past=None, past_length=None
-    ):
+    def create_kv_cache(self, batch_size, dtype=None, device=None, start=0, end=None):
+        # start, end: only cache the blocks[start:end]
+        if end is None:
+            end = self.config.n_layer
+        weight = self.blocks[0].attn.proj.weight
+        return KVCache(
+            end - start,
+            batch_size,
+            self.config.n_head,
+            self.block_size,
+            self.config.n_embd // self.config.n_head,
+            dtype=weight.dtype if dtype is None else dtype,
+            device=weight.device if device is None else device,
+            first_layer=start,
+        )
+
+    def forward_with_past(self, embeddings, past=None, start=0, end=None):
+        """
+        run blocks[start:end] on the newest tokens only, reusing cached keys and values
+        embeddings: B x T x C, input of block start (computed by the caller)
+        past: KVCache, updated in place, or list of n_layer caches,
+        each 2 x B x nh x len_past x hs or None
+        returns the output of block end - 1 and the presents of blocks[start:end],
+        each 2 x B x nh x T x hs (None when past is a KVCache)
+        """
         # inference only
         assert not self.training
-        # each index maps to a (learnable) vector
-        token_embeddings = self.tok_emb(idx)
-        if embeddings is not None:  # prepend explicit embeddings
-            token_embeddings = torch.cat((embeddings, token_embeddings), dim=1)
-
-        if past is not None:
-            assert past_length is not None
-            # n_layer, 2, b, nh, len_past, dim_head
-            past = torch.cat(past, dim=-2)
-            past_shape = list(past.shape)
-            expected_shape = [
-                self.config.n_layer,
-                2,
-                idx.shape[0],
-                self.config.n_head,
-                past_length,
-                self.config.n_embd // self.config.n_head,
-            ]
-            assert past_shape == expected_shape, f"{past_shape} =/= {expected_shape}"
-            # each position maps to a (learnable) vector
-            position_embeddings = self.pos_emb[:, past_length, :]
-        else:
-            position_embeddings = self.pos_emb[:, : token_embeddings.shape[1], :]
-
-        x = self.drop(token_embeddings + position_embeddings)
+        if end is None:
+            end = len(self.blocks)
+
+        x = embeddings
+        if isinstance(past, KVCache):
+            for i in range(start, end):
+                x = self.blocks[i](x, kv_cache=past, layer_idx=i)
+            return x, None
+
         presents = []  # accumulate over layers
-        for i, block in enumerate(self.blocks):
-            x, present = block(
+        for i in range(start, end):
+            x, present = self.blocks[i](
                 x,
-                layer_past=past[i, ...] if past is not None else None,
+                layer_past=past[i] if past is not None else None,
                 return_present=True,
             )
             presents.append(present)
 
-        x = self.ln_f(x)
-        logits = self.head(x)
-        # if we are given some desired targets also calculate the loss
-        loss = None
-        if targets is not None:
-            loss = F.cross_entropy(logits.view(-1, logits.size(-1)), targets.view(-1))
-
-        # _, _, n_layer, 2, b, nh, 1, dim_head
-        return logits, loss, torch.stack(presents)
+        return x, presents
+
+    @staticmethod
+    def append_past(past, presents, start=0):
+        # past: list of n_layer caches, updated in place with presents of blocks[start:]
+        for i, present in enumerate(presents, start):
+            if past[i] is None:
+                past[i] = present
+            else:
+                past[i] = torch.cat((past[i], present), dim=-2)
+        return past
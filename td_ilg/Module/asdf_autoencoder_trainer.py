@@ -12,6 +12,7 @@ from a_sdf.Method.path import createFileFolder, renameFile, removeFile
 from a_sdf.Module.logger import Logger
 
 from td_ilg.Dataset.points import PointsDataset
+from td_ilg.Dataset.cached_points import CachedPointsDataset
 from td_ilg.Model.asdf_autoencoder import ASDFAutoEncoder
 from td_ilg.Method.time import getCurrentTime
 
@@ -29,8 +30,8 @@ class ASDFAutoEncoderTrainer(object):
         self.sample_direction_num = 400
         self.direction_upscale = 4
 
-        self.batch_size = 1
-        self.accumulation_steps = 64
+        self.batch_size = 8
+        self.accumulation_steps = 8
         self.num_workers = 0
         self.lr = 1e-2
         self.weight_decay = 1e-10
@@ -49,6 +50,10 @@ class ASDFAutoEncoderTrainer(object):
             '_dirup' + str(self.direction_upscale)
         self.device = 'cuda'
         self.points_dataset_folder_path = '/home/chli/chLi/Dataset/ShapeNet/points/10000/'
+        # NeighbourCacher output of the chair points, e.g.
+        # '/home/chli/chLi/Dataset/ShapeNet/neighbours/10000/03001627/', the whole
+        # clouds are then encoded with their cached fps and knn indices
+        self.neighbour_dataset_folder_path = None
 
         self.model = ASDFAutoEncoder(
             asdf_channel=self.asdf_channel,
@@ -61,14 +66,25 @@ class ASDFAutoEncoderTrainer(object):
             direction_upscale=self.direction_upscale
         ).to(self.device)
 
-        self.train_dataset = PointsDataset(self.points_dataset_folder_path)
+        if self.neighbour_dataset_folder_path is None:
+            self.train_dataset = PointsDataset(self.points_dataset_folder_path)
+        else:
+            # FIXME: only chair here, as in PointsDataset
+            self.train_dataset = CachedPointsDataset(
+                self.points_dataset_folder_path + '03001627/',
+                self.neighbour_dataset_folder_path)
         # self.eval_dataset = PointsDataset(self.points_dataset_folder_path)
+        # PointsDataset draws a random sample point number, fixed per batch
+        collate_fn = None
+        if isinstance(self.train_dataset, PointsDataset):
+            collate_fn = self.train_dataset.collate
         self.train_dataloader = DataLoader(self.train_dataset,
                                            batch_size=self.batch_size,
                                            shuffle=True,
                                            drop_last=True,
                                            num_workers=self.num_workers,
-                                           worker_init_fn=worker_init_fn)
+                                           worker_init_fn=worker_init_fn,
+                                           collate_fn=collate_fn)
         '''
         self.eval_dataloader = DataLoader(self.eval_dataset,
                                           batch_size=self.batch_size,
@@ -144,10 +160,10 @@ class ASDFAutoEncoderTrainer(object):
     def getLr(self) -> float:
         return self.optimizer.state_dict()["param_groups"][0]["lr"]
 
-    def trainStep(self, sample_points, gt_points):
+    def trainStep(self, sample_points, gt_points, idxs=None, knn_idxs=None):
         self.model.train()
 
-        asdf_points = self.model(sample_points)
+        asdf_points = self.model(sample_points, idxs, knn_idxs)
 
         fit_dists2, coverage_dists2 = chamferDistance(
             asdf_points, gt_points, self.device == "cpu"
@@ -229,12 +245,22 @@ class ASDFAutoEncoderTrainer(object):
                   str(total_epoch) + "...")
             if print_progress:
                 pbar = tqdm(total=len(self.train_dataloader))
-            for sample_points, gt_points in self.train_dataloader:
+            for data in self.train_dataloader:
                 self.step += 1
 
+                if self.neighbour_dataset_folder_path is None:
+                    sample_points, gt_points = data
+                    idxs, knn_idxs = None, None
+                else:
+                    # the cached indices refer to the whole cloud, encoded as is
+                    gt_points, idxs, knn_idxs = data
+                    sample_points = gt_points
+                    idxs = idxs.to(self.device, non_blocking=True)
+                    knn_idxs = knn_idxs.to(self.device, non_blocking=True)
+
                 sample_points = sample_points.to(self.device, non_blocking=True)
                 gt_points = gt_points.to(self.device, non_blocking=True)
-                loss = self.trainStep(sample_points, gt_points)
+                loss = self.trainStep(sample_points, gt_points, idxs, knn_idxs)
 
 
                 if print_progress:
@@ -0,0 +1,331 @@
+import queue
+import torch
+import pickle
+import traceback
+import numpy as np
+import torch.multiprocessing as mp
+from collections import deque
+
+from td_ilg.Method.model import createGenerators
+from td_ilg.Model.asdf_class_encoder import ASDFClassEncoder
+
+
+def toGeneratorStates(generators):
+    if generators is None:
+        return None
+    return [generator.get_state() for generator in generators]
+
+
+def toGenerators(generator_states):
+    if generator_states is None:
+        return None
+
+    generators = []
+    for generator_state in generator_states:
+        generator = torch.Generator()
+        generator.set_state(generator_state)
+        generators.append(generator)
+    return generators
+
+
+def toPicklable(value):
+    # per-anchor tensors are tiny, pickling them is much cheaper than moving each
+    # one to its own shared memory segment
+    if torch.is_tensor(value):
+        return value.numpy()
+    if isinstance(value, (list, tuple)):
+        return type(value)(toPicklable(item) for item in value)
+    return value
+
+
+def fromPicklable(value):
+    if isinstance(value, np.ndarray):
+        return torch.from_numpy(value)
+    if isinstance(value, (list, tuple)):
+        return type(value)(fromPicklable(item) for item in value)
+    return value
+
+
+def toMessage(value):
+    # pickled by the sender instead of the queue feeder thread, which would only
+    # print a pickling error and drop the message
+    return pickle.dumps(toPicklable(value), protocol=pickle.HIGHEST_PROTOCOL)
+
+
+def fromMessage(message):
+    return fromPicklable(pickle.loads(message))
+
+
+def runStageWorker(
+    model, stage_idx, input_queue, output_queue, num_threads, sample_kwargs
+):
+    """
+    decode one stage of every group of shapes sent to input_queue, in arrival order
+    message: (group_id, position, x, coord_token_embeddings, coords, generator_states)
+    an error is sent on as a str message with its traceback, down to the main process
+    """
+    torch.set_num_threads(num_threads)
+    # finished messages may be left unread after an error, never block the exit
+    output_queue.cancel_join_thread()
+
+    start, end = model.stage_blocks[stage_idx]
+    # KVCache of the stage blocks of each group in flight
+    pasts = {}
+
+    with torch.no_grad():
+        while True:
+            message = input_queue.get()
+            if message is None:
+                break
+            if isinstance(message, str):
+                output_queue.put(message)
+                continue
+
+            try:
+                (
+                    group_id,
+                    position,
+                    x,
+                    coord_token_embeddings,
+                    coords,
+                    generator_states,
+                ) = fromMessage(message)
+
+                if position == 0:
+                    pasts[group_id] = model.transformer.create_kv_cache(
+                        x.shape[0], start=start, end=end
+                    )
+
+                # the random streams travel with the group, so every stage draws
+                # from them in the same order as ASDFClassEncoder.sample
+                generators = toGenerators(generator_states)
+                x, coord, coord_token_embeddings = model.sample_stage(
+                    stage_idx,
+                    x,
+                    coord_token_embeddings,
+                    position,
+                    pasts[group_id],
+                    generators=generators,
+                    **sample_kwargs,
+                )
+                if coord is not None:
+                    coords = coords + [coord]
+
+                if position == model.reso - 1:
+                    del pasts[group_id]
+
+                output_queue.put(
+                    toMessage(
+                        (
+                            group_id,
+                            position,
+                            x,
+                            coord_token_embeddings,
+                            coords,
+                            toGeneratorStates(generators),
+                        )
+                    )
+                )
+            except Exception:
+                output_queue.put(
+                    "stage "
+                    + str(stage_idx)
+                    + " worker failed:\n"
+                    + traceback.format_exc()
+                )
+    return True
+
+
+class ASDFPipelineSampler(object):
+    """
+    Sample ASDFClassEncoder shapes on CPU with every stage of the staged GPT stack
+    in its own worker process. The weights are shared by all workers through shared
+    memory, stages are connected by torch.multiprocessing queues and the last stage
+    hands each anchor back to stage 0, so many groups of shapes are decoded at once
+    in a wavefront and every stage works on a different group.
+    Each group gives the same result as model.sample(cond, seeds=seeds).
+    """
+
+    def __init__(
+        self,
+        model: ASDFClassEncoder,
+        num_threads=None,
+        max_inflight_groups=None,
+        timeout=None,
+        **sample_kwargs,
+    ) -> None:
+        self.model = model
+        self.stage_num = len(model.stage_blocks)
+        # threads of each worker, the cores are split between the stages by default
+        self.num_threads = num_threads
+        if self.num_threads is None:
+            self.num_threads = max(1, torch.get_num_threads() // self.stage_num)
+        # groups decoded at once, enough to keep every stage busy by default
+        self.max_inflight_groups = max_inflight_groups
+        if self.max_inflight_groups is None:
+            self.max_inflight_groups = 2 * self.stage_num
+        # seconds to wait for a finished anchor before raising, forever by default
+        self.timeout = timeout
+        # seconds between two checks of the workers while waiting
+        self.poll_interval = 1.0
+        self.sample_kwargs = sample_kwargs
+
+        self.workers = []
+        self.queues = []
+        return
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *args):
+        self.stop()
+        return
+
+    def start(self) -> bool:
+        if len(self.workers) > 0:
+            return True
+
+        self.model.eval()
+        self.model.share_memory()
+
+        context = mp.get_context("spawn")
+        # queues[i] feeds stage i, queues[-1] returns the finished anchors
+        self.queues = [context.Queue() for _ in range(self.stage_num + 1)]
+        for stage_idx in range(self.stage_num):
+            worker = context.Process(
+                target=runStageWorker,
+                args=(
+                    self.model,
+                    stage_idx,
+                    self.queues[stage_idx],
+                    self.queues[stage_idx + 1],
+                    self.num_threads,
+                    self.sample_kwargs,
+                ),
+                daemon=True,
+            )
+            worker.start()
+            self.workers.append(worker)
+        return True
+
+    def stop(self) -> bool:
+        for queue in self.queues[:-1]:
+            queue.put(None)
+        for worker in self.workers:
+            worker.join()
+
+        self.workers = []
+        self.queues = []
+        return True
+
+    def getOutput(self):
+        # next finished anchor, re-raises worker errors instead of blocking forever
+        waited_time = 0.0
+        while True:
+            try:
+                message = self.queues[-1].get(timeout=self.poll_interval)
+            except queue.Empty:
+                for stage_idx, worker in enumerate(self.workers):
+                    if not worker.is_alive():
+                        raise RuntimeError(
+                            "stage "
+                            + str(stage_idx)
+                            + " worker exited with code "
+                            + str(worker.exitcode)
+                        )
+                waited_time += self.poll_interval
+                if self.timeout is not None and waited_time >= self.timeout:
+                    raise TimeoutError(
+                        "no anchor finished within " + str(self.timeout) + "s"
+                    )
+                continue
+
+            if isinstance(message, str):
+                raise RuntimeError(message)
+            return fromMessage(message)
+
+    @torch.no_grad()
+    def sample(self, cond_list, seeds_list=None) -> list:
+        """
+        cond_list: list of B_i x C conditions, each decoded as one batch
+        seeds_list: optional list of B_i per-shape seeds for each group
+        returns the list of B_i x reso x asdf_dim samples
+        """
+        assert len(self.workers) > 0, "call start() first"
+
+        if seeds_list is None:
+            seeds_list = [None] * len(cond_list)
+
+        coords_lists = [[] for _ in cond_list]
+        latent_lists = [[] for _ in cond_list]
+        pending_groups = deque(range(len(cond_list)))
+
+        def submitGroup(group_id):
+            generators = createGenerators(seeds_list[group_id])
+            self.queues[0].put(
+                toMessage(
+                    (
+                        group_id,
+                        0,
+                        cond_list[group_id][:, None].cpu(),
+                        None,
+                        [],
+                        toGeneratorStates(generators),
+                    )
+                )
+            )
+            return True
+
+        while pending_groups and (
+            len(cond_list) - len(pending_groups) < self.max_inflight_groups
+        ):
+            submitGroup(pending_groups.popleft())
+
+        finished_group_num = 0
+        while finished_group_num < len(cond_list):
+            (
+                group_id,
+                position,
+                latent,
+                next_token_embeddings,
+                coords,
+                generator_states,
+            ) = self.getOutput()
+
+            coords_lists[group_id].append(
+                torch.cat([coord.unsqueeze(-1) for coord in coords], dim=-1)
+            )
+            latent_lists[group_id].append(latent)
+
+            if position + 1 < self.model.reso:
+                self.queues[0].put(
+                    toMessage(
+                        (
+                            group_id,
+                            position + 1,
+                            next_token_embeddings,
+                            None,
+                            [],
+                            generator_states,
+                        )
+                    )
+                )
+                continue
+
+            finished_group_num += 1
+            if pending_groups:
+                submitGroup(pending_groups.popleft())
+
+        samples = []
+        for coords_list, latent_list in zip(coords_lists, latent_lists):
+            coords = torch.cat(coords_list, dim=1)  # B x S x 6
+            latent = torch.cat(latent_list, dim=1)  # B x S x (asdf_dim - 6)
+            samples.append(torch.cat([coords / 128.0 - 1.0, latent], dim=-1))
+        return samples
+
+    @torch.no_grad()
+    def sample_classes(self, categories_list, seeds_list=None) -> list:
+        # categories_list: list of class id tensors, one group of shapes each
+        cond_list = [self.model.class_enc(categories) for categories in categories_list]
+        return self.sample(cond_list, seeds_list)
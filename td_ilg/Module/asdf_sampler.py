@@ -16,6 +16,12 @@ class ASDFSampler(object):
         )
         self.device = "cpu"
         self.resolution = 100
+        # GPT attention backend and sliding window, see GPTConfig
+        self.attn_backend = "vanilla"
+        self.attn_window = 0
+        # one generated shape per category, sampled together in one batch
+        self.categories = [0]
+        self.seeds = None
         return
 
     def toInitialASDFModel(self) -> ASDFModel:
@@ -78,6 +84,8 @@ class ASDFSampler(object):
             nclasses=55,
             coord_vocab_size=256,
             reso=self.resolution,
+            attn_backend=self.attn_backend,
+            attn_window=self.attn_window,
         )
 
         model.to(self.device)
@@ -87,10 +95,12 @@ class ASDFSampler(object):
 
         asdf_list = []
 
-        for i in tqdm(range(1)):
-            categories = torch.Tensor([0]).long()
-            cond = model.class_enc(categories)
-            asdf_params = model.sample(cond).cpu().numpy()[0]
+        categories = torch.Tensor(self.categories).long().to(self.device)
+        asdf_params_array = (
+            model.sample_classes(categories, seeds=self.seeds).cpu().numpy()
+        )
+
+        for asdf_params in tqdm(asdf_params_array):
             asdf_model = self.toInitialASDFModel()
             asdf_model.loadParams(asdf_params)
             asdf_list.append(asdf_model)
@@ -99,7 +109,7 @@ class ASDFSampler(object):
 
         points = []
 
-        for i in range(len(asdf_list)):
+        for i, asdf_model in enumerate(asdf_list):
             # asdf_model.renderDetectPoints(rad_density)
             # asdf_model.renderDetectMaskViewCones(rad_density, cone_render_scale, cone_color)
 
@@ -32,6 +32,11 @@ from td_ilg.Module.Logger.tensorboard import TensorboardLogger
 class ASDFTrainer(object):
     def __init__(self) -> None:
         self.resolution = 100
+        # anchor order, "random" or "xyz", "morton", "hilbert", see td_ilg.Method.curve
+        self.anchor_order = "random"
+        # GPT attention backend and sliding window, see GPTConfig
+        self.attn_backend = "vanilla"
+        self.attn_window = 0
 
         self.batch_size = 1600
         self.epochs = 40000000
@@ -344,7 +349,7 @@ class ASDFTrainer(object):
 
         cudnn.benchmark = True
 
-        dataset_train = ASDFDataset(self.asdf_dataset_folder_path)
+        dataset_train = ASDFDataset(self.asdf_dataset_folder_path, self.anchor_order)
 
         if len(dataset_train) < self.batch_size:
             self.batch_size = len(dataset_train)
@@ -352,7 +357,7 @@ class ASDFTrainer(object):
         if self.disable_eval:
             dataset_val = None
         else:
-            dataset_val = ASDFDataset(self.asdf_dataset_folder_path)
+            dataset_val = ASDFDataset(self.asdf_dataset_folder_path, self.anchor_order)
 
         if True:  # self.distributed:
             num_tasks = get_world_size()
@@ -425,6 +430,8 @@ class ASDFTrainer(object):
             nclasses=55,
             coord_vocab_size=256,
             reso=self.resolution,
+            attn_backend=self.attn_backend,
+            attn_window=self.attn_window,
         )
 
         model.to(self.device)
@@ -0,0 +1,44 @@
+import os
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from td_ilg.Method.neighbour import computeNeighbours, saveNeighbours, toNeighbourNum
+
+
+class NeighbourCacher(object):
+    """
+    Precompute the fps samples and kNN graphs the encoders build from
+    un-augmented point clouds, one .npz with fps_idx and knn_idx per .npy points file
+    """
+
+    def __init__(self) -> None:
+        # "asdf": graphs of ASDFEncoder, "vqvae": graphs of the VQVAE Encoder
+        self.encoder_type = "asdf"
+        # asdf_channel of ASDFEncoder, N of the VQVAE Encoder, k follows from it
+        self.sample_num = 40
+        self.device = "cpu"
+        return
+
+    def cacheFile(self, points_file_path: str, save_file_path: str) -> bool:
+        points = np.load(points_file_path, allow_pickle=True)
+        points = torch.from_numpy(points).type(torch.float32).to(self.device)
+
+        k = toNeighbourNum(points.shape[0], self.sample_num, self.encoder_type)
+        fps_idx, knn_idx = computeNeighbours(points, self.sample_num, k)
+        return saveNeighbours(save_file_path, fps_idx, knn_idx)
+
+    def cacheFolder(self, points_folder_path: str, save_folder_path: str) -> bool:
+        points_filename_list = os.listdir(points_folder_path)
+
+        for points_filename in tqdm(points_filename_list):
+            if points_filename[-4:] != ".npy":
+                continue
+
+            save_file_path = save_folder_path + points_filename[:-4] + ".npz"
+            if os.path.exists(save_file_path):
+                continue
+
+            self.cacheFile(points_folder_path + points_filename, save_file_path)
+
+        return True
@@ -11,6 +11,10 @@ class Sampler(object):
         self.model_path = "./test.pth"
         self.device = "cpu"
         self.category = 0
+        self.seeds = None
+        # GPT attention backend and sliding window, see GPTConfig
+        self.attn_backend = "vanilla"
+        self.attn_window = 0
         return
 
     @torch.no_grad()
@@ -34,6 +38,8 @@ class Sampler(object):
             coord_vocab_size=256,
             latent_vocab_size=1024,
             reso=12,
+            attn_backend=self.attn_backend,
+            attn_window=self.attn_window,
         )
 
         model.to(self.device)
@@ -41,15 +47,18 @@ class Sampler(object):
         # model.load_state_dict(checkpoint["model"])
         model.eval()
 
+        # a list of categories samples one shape per entry in a single batch
         id = self.category
-        categories = torch.Tensor([id]).long()
+        if isinstance(id, int):
+            id = [id]
+        categories = torch.Tensor(id).long().to(self.device)
 
         print("start model cond")
         cond = model.class_enc(categories)
         print("cond:")
         print(cond.shape)
 
-        x, y, z, latent = model.sample(cond)
+        x, y, z, latent = model.sample(cond, seeds=self.seeds)
 
         print(x.shape)
         print(y.shape)
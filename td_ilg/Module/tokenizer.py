@@ -0,0 +1,115 @@
+import os
+import torch
+import numpy as np
+from tqdm import tqdm
+
+from td_ilg.Dataset.shapenet import ShapeNet
+from td_ilg.Dataset.axis_scaling import AxisScaling
+from td_ilg.Model.VQVAE.auto_encoder import AutoEncoder
+from td_ilg.Method.sort import sortCenters
+
+
+class Tokenizer(object):
+    """
+    Encode a dataset with a frozen VQVAE once, so ClassEncoder training reads the
+    sorted quantized centers and code indices instead of running AutoEncoder.encode
+    every step. Tokens are written to shards of shard_size shapes:
+    centers: S x T x 3 uint8, codes: S x T int16, categories: S int16,
+    center_order: the center_order they are sorted with
+    """
+
+    def __init__(self) -> None:
+        self.resolution = 12
+        self.codebook_size = 24
+        # center order, "xyz", "morton" or "hilbert", see td_ilg.Method.curve
+        self.center_order = "xyz"
+        self.point_cloud_size = 2048
+
+        self.data_path = "./test/"
+        self.vqvae_model_file_path = None
+        self.save_folder_path = "./output/tokens/"
+        self.split = "train"
+        # extra AxisScaling augmented encodings of every shape, 0 only encodes it as is
+        self.augment_num = 0
+        self.shard_size = 4096
+        self.batch_size = 32
+        self.num_workers = 16
+        self.device = "cpu"
+        return
+
+    def loadVQVAE(self) -> AutoEncoder:
+        vqvae = AutoEncoder(N=self.resolution, K=self.codebook_size, M=2048)
+        if self.vqvae_model_file_path is not None:
+            vqvae.load_state_dict(
+                torch.load(self.vqvae_model_file_path, map_location="cpu")["model"]
+            )
+        vqvae.eval()
+        vqvae.to(self.device)
+        return vqvae
+
+    def saveShard(self, shard_idx: int, centers_list, codes_list, categories_list):
+        os.makedirs(self.save_folder_path, exist_ok=True)
+        np.savez(
+            self.save_folder_path + self.split + "_" + str(shard_idx).zfill(5) + ".npz",
+            centers=np.concatenate(centers_list).astype(np.uint8),
+            codes=np.concatenate(codes_list).astype(np.int16),
+            categories=np.concatenate(categories_list).astype(np.int16),
+            center_order=np.array(self.center_order),
+        )
+        return True
+
+    @torch.no_grad()
+    def tokenize(self) -> bool:
+        assert self.codebook_size <= np.iinfo(np.int16).max + 1
+
+        dataset = ShapeNet(
+            self.data_path,
+            split=self.split,
+            transform=None,
+            sampling=False,
+            return_surface=True,
+            surface_sampling=True,
+            pc_size=self.point_cloud_size,
+        )
+        data_loader = torch.utils.data.DataLoader(
+            dataset,
+            batch_size=self.batch_size,
+            shuffle=False,
+            num_workers=self.num_workers,
+            drop_last=False,
+        )
+        axis_scaling = AxisScaling((0.75, 1.25), True)
+
+        vqvae = self.loadVQVAE()
+
+        shard_idx = 0
+        centers_list, codes_list, categories_list = [], [], []
+        for _, _, surface, categories in tqdm(data_loader):
+            surfaces = [surface]
+            for _ in range(self.augment_num):
+                surfaces.append(
+                    torch.stack(
+                        [axis_scaling(shape, shape[:1])[0] for shape in surface]
+                    )
+                )
+
+            for surface in surfaces:
+                _, _, centers_quantized, _, _, encodings = vqvae.encode(
+                    surface.to(self.device)
+                )
+                centers_quantized, encodings = sortCenters(
+                    centers_quantized, encodings, self.center_order
+                )
+
+                centers_list.append(centers_quantized.cpu().numpy())
+                codes_list.append(encodings.cpu().numpy())
+                categories_list.append(np.asarray(categories))
+
+            if sum(codes.shape[0] for codes in codes_list) >= self.shard_size:
+                self.saveShard(shard_idx, centers_list, codes_list, categories_list)
+                shard_idx += 1
+                centers_list, codes_list, categories_list = [], [], []
+
+        if len(codes_list) > 0:
+            self.saveShard(shard_idx, centers_list, codes_list, categories_list)
+        return True
@@ -12,6 +12,7 @@ from typing import Iterable, Optional
 
 from td_ilg.Data.smoothed_value import SmoothedValue
 from td_ilg.Dataset.datasets import build_shape_surface_occupancy_dataset
+from td_ilg.Dataset.tokens import TokenDataset
 from td_ilg.Model.class_encoder import ClassEncoder
 from td_ilg.Model.VQVAE.auto_encoder import AutoEncoder
 from td_ilg.Method.io import save_model, auto_load_model
@@ -33,6 +34,11 @@ from td_ilg.Module.Logger.tensorboard import TensorboardLogger
 class Trainer(object):
     def __init__(self) -> None:
         self.resolution = 12
+        # center order, "xyz", "morton" or "hilbert", see td_ilg.Method.curve
+        self.center_order = "xyz"
+        # GPT attention backend and sliding window, see GPTConfig
+        self.attn_backend = "vanilla"
+        self.attn_window = 0
 
         self.batch_size = 2
         self.epochs = 400
@@ -60,6 +66,8 @@ class Trainer(object):
         self.warmup_steps = -1
 
         self.data_path = "./test/"
+        # shards written by Tokenizer, skips the VQVAE encoding of every step
+        self.token_folder_path = None
         self.output_dir = "./output/"
         self.log_dir = "./logs/"
         self.device = "cpu"
@@ -84,14 +92,21 @@ class Trainer(object):
         self.dist_url = "env://"
         return
 
-    def train_batch(self, model, vqvae, surface, categories, criterion):
-        with torch.no_grad():
-            _, _, centers_quantized, _, _, encodings = vqvae.encode(surface)
-            print("surface:", surface.shape)
-            print("centers_quantized:", centers_quantized.shape)
-            print("encodings:", encodings.shape)
-
-        centers_quantized, encodings = sortCenters(centers_quantized, encodings)
+    def train_batch(self, model, vqvae, surface, categories, criterion, tokens=None):
+        # tokens: sorted centers_quantized and encodings from a TokenDataset,
+        # replaces the encoding of surface
+        if tokens is None:
+            with torch.no_grad():
+                _, _, centers_quantized, _, _, encodings = vqvae.encode(surface)
+                print("surface:", surface.shape)
+                print("centers_quantized:", centers_quantized.shape)
+                print("encodings:", encodings.shape)
+
+            centers_quantized, encodings = sortCenters(
+                centers_quantized, encodings, self.center_order
+            )
+        else:
+            centers_quantized, encodings = tokens
 
         x_logits, y_logits, z_logits, latent_logits = model(
             centers_quantized, encodings, categories
@@ -117,6 +132,22 @@ class Trainer(object):
             loss_latent.item(),
         )
 
+    def load_batch(self, batch, device):
+        # returns the surface or the precomputed tokens of a batch, and its categories
+        if self.token_folder_path is None:
+            _, _, surface, categories = batch
+            surface = surface.to(device, non_blocking=True)
+            tokens = None
+        else:
+            centers_quantized, encodings, categories = batch
+            surface = None
+            tokens = (
+                centers_quantized.to(device, non_blocking=True),
+                encodings.to(device, non_blocking=True),
+            )
+        categories = categories.to(device, non_blocking=True)
+        return surface, tokens, categories
+
     def train_one_epoch(
         self,
         model: torch.nn.Module,
@@ -151,7 +182,7 @@ class Trainer(object):
         else:
             optimizer.zero_grad()
 
-        for data_iter_step, (_, _, surface, categories) in enumerate(
+        for data_iter_step, batch in enumerate(
             metric_logger.log_every(data_loader, print_freq, header)
         ):
             step = data_iter_step // update_freq
@@ -175,15 +206,14 @@ class Trainer(object):
                     ):
                         param_group["weight_decay"] = wd_schedule_values[it]
 
-            surface = surface.to(device, non_blocking=True)
-            categories = categories.to(device, non_blocking=True)
+            surface, tokens, categories = self.load_batch(batch, device)
 
             if loss_scaler is None:
                 raise NotImplementedError
             else:
                 with torch.cuda.amp.autocast():
                     loss, loss_x, loss_y, loss_z, loss_latent = self.train_batch(
-                        model, vqvae, surface, categories, criterion
+                        model, vqvae, surface, categories, criterion, tokens
                     )
 
             loss_value = loss.item()
@@ -271,16 +301,19 @@ class Trainer(object):
         model.eval()
 
         for batch in metric_logger.log_every(data_loader, 1000, header):
-            _, _, surface, categories = batch
-            surface = surface.to(device, non_blocking=True)
-            categories = categories.to(device, non_blocking=True)
+            surface, tokens, categories = self.load_batch(batch, device)
 
             # compute output
             with torch.cuda.amp.autocast():
-                with torch.no_grad():
-                    _, _, centers_quantized, _, _, encodings = vqvae.encode(surface)
+                if tokens is None:
+                    with torch.no_grad():
+                        _, _, centers_quantized, _, _, encodings = vqvae.encode(surface)
 
-                centers_quantized, encodings = sortCenters(centers_quantized, encodings)
+                    centers_quantized, encodings = sortCenters(
+                        centers_quantized, encodings, self.center_order
+                    )
+                else:
+                    centers_quantized, encodings = tokens
 
                 x_logits, y_logits, z_logits, latent_logits = model(
                     centers_quantized, encodings, categories
@@ -315,11 +348,18 @@ class Trainer(object):
 
         cudnn.benchmark = True
 
-        dataset_train = build_shape_surface_occupancy_dataset("train", args=self)
+        if self.token_folder_path is None:
+            dataset_train = build_shape_surface_occupancy_dataset("train", args=self)
+        else:
+            dataset_train = TokenDataset(
+                self.token_folder_path, "train", self.center_order
+            )
         if self.disable_eval:
             dataset_val = None
-        else:
+        elif self.token_folder_path is None:
             dataset_val = build_shape_surface_occupancy_dataset("val", args=self)
+        else:
+            dataset_val = TokenDataset(self.token_folder_path, "val", self.center_order)
 
         if True:  # self.distributed:
             num_tasks = get_world_size()
@@ -392,16 +432,20 @@ class Trainer(object):
             coord_vocab_size=256,
             latent_vocab_size=1024,
             reso=self.resolution,
+            attn_backend=self.attn_backend,
+            attn_window=self.attn_window,
         )
 
         model.to(self.device)
 
-        # vqvae = AutoEncoder(N=128, K=512, M=2048)
-        vqvae = AutoEncoder(N=self.resolution, K=24, M=2048)
-        vqvae.eval()
-        # FIXME: load auto encoder
-        # vqvae.load_state_dict(torch.load(self.vqvae_pth)["model"])
-        vqvae.to(self.device)
+        vqvae = None
+        if self.token_folder_path is None:
+            # vqvae = AutoEncoder(N=128, K=512, M=2048)
+            vqvae = AutoEncoder(N=self.resolution, K=24, M=2048)
+            vqvae.eval()
+            # FIXME: load auto encoder
+            # vqvae.load_state_dict(torch.load(self.vqvae_pth)["model"])
+            vqvae.to(self.device)
 
         model_ema = None
         if self.model_ema:
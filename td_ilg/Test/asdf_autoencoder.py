@@ -13,7 +13,7 @@ def test():
     sh_2d_degree = 3
     sh_3d_degree = 6
     hidden_dim = 128
-    batch_size = 1
+    batch_size = 2
 
     points = torch.rand(batch_size, 2344, 3)
     idxs = torch.randint(0, 2344, [batch_size, asdf_channel])
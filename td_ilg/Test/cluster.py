@@ -0,0 +1,61 @@
+import time
+import torch
+
+from td_ilg.Method import cluster
+
+
+def benchmark(func, *args, repeat_num=3, **kwargs):
+    result = func(*args, **kwargs)
+    start = time.time()
+    for _ in range(repeat_num):
+        func(*args, **kwargs)
+    return result, (time.time() - start) / repeat_num
+
+
+def test():
+    batch_size = 8
+    point_num = 2048
+    asdf_channel = 40
+    k = 32
+
+    pos = torch.rand(batch_size * point_num, 3)
+    batch = torch.repeat_interleave(torch.arange(batch_size), point_num)
+
+    idx, fps_time = benchmark(
+        cluster.fps, pos, batch, ratio=asdf_channel / point_num, random_start=False
+    )
+    edge_index, knn_time = benchmark(cluster.knn, pos, pos[idx], k, batch, batch[idx])
+    print("fallback fps:", fps_time, "s, knn:", knn_time, "s")
+
+    try:
+        import torch_cluster
+    except ImportError:
+        print("torch_cluster not found, only the fallback was timed")
+        return True
+
+    cluster_idx, cluster_fps_time = benchmark(
+        torch_cluster.fps,
+        pos,
+        batch,
+        ratio=asdf_channel / point_num,
+        random_start=False,
+    )
+    cluster_edge_index, cluster_knn_time = benchmark(
+        torch_cluster.knn, pos, pos[idx], k, batch, batch[idx]
+    )
+    print("torch_cluster fps:", cluster_fps_time, "s, knn:", cluster_knn_time, "s")
+
+    print("fps same samples:", torch.equal(idx, cluster_idx))
+    # neighbours of equal distance may be listed in another order
+    dist = (pos[edge_index[1]] - pos[idx][edge_index[0]]).norm(dim=1)
+    cluster_dist = (pos[cluster_edge_index[1]] - pos[idx][cluster_edge_index[0]]).norm(
+        dim=1
+    )
+    print(
+        "knn same edges:",
+        torch.equal(edge_index[0], cluster_edge_index[0])
+        and torch.allclose(
+            dist.view(-1, k).sort(dim=1)[0], cluster_dist.view(-1, k).sort(dim=1)[0]
+        ),
+    )
+    return True
@@ -1,6 +1,8 @@
 from td_ilg.Test.asdf_encoder import test as test_encode_asdf
 from td_ilg.Test.asdf_autoencoder import test as test_autoencode_asdf
+from td_ilg.Test.cluster import test as test_cluster
 
 if __name__ == "__main__":
     test_encode_asdf()
     test_autoencode_asdf()
+    test_cluster()
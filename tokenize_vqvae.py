@@ -0,0 +1,4 @@
+from td_ilg.Demo.tokenizer import demo as demo_tokenize
+
+if __name__ == "__main__":
+    demo_tokenize()